@@ -0,0 +1,68 @@
+import argparse
+import random
+import time
+
+import trueskill
+
+from itertools import combinations
+
+from risk.model import balance
+from risk.model.match import Player
+
+
+def legacy_team_formats(players):
+    players = range(len(players))
+    iterables = combinations(players, len(players) // 2)
+    groups = map(lambda team: sorted([list(team), list(set(players) - set(team))]), iterables)
+    team_formats = []
+
+    for group in groups:
+        if group not in team_formats:
+            team_formats.append(list(group))
+
+    return team_formats
+
+
+def legacy_balance(players):
+    results = {}
+    for team_format in legacy_team_formats(players):
+        setup = [[trueskill.Rating(mu=players[m].mu, sigma=players[m].sigma) for m in team] for team in team_format]
+        results[tuple(map(tuple, team_format))] = trueskill.quality(setup)
+    best_quality = max(results.values())
+    return {frozenset(k[0]) for k, v in results.items() if v == best_quality}
+
+
+def vectorized_balance(players):
+    splits = balance.canonical_splits(balance.team_sizes(len(players), len(players) // 2))
+    mu, sigma = balance.ratings(players)
+    results = balance.quality(mu, sigma, splits, 2)
+    return {frozenset(int(m) for m in (splits[n] == 0).nonzero()[0]) for n in balance.best(results)}
+
+
+def timed(func, players, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(players)
+    return (time.perf_counter() - start) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare legacy and vectorized team balancing")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[8, 10, 12, 16])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'players':>8} {'splits':>8} {'legacy':>12} {'vectorized':>12} {'speedup':>9}  same")
+    for size in args.sizes:
+        players = [Player(str(n), rng.gauss(25, 5), rng.uniform(1, 25 / 3), 0) for n in range(size)]
+        legacy, expected = timed(legacy_balance, players, args.repeat)
+        vectorized, result = timed(vectorized_balance, players, args.repeat)
+        splits = balance.count_splits(balance.team_sizes(size, size // 2))
+        print(f"{size:>8} {splits:>8} {legacy * 1000:>10.2f}ms {vectorized * 1000:>10.2f}ms "
+              f"{legacy / vectorized:>8.1f}x  {expected == result}")
+
+
+if __name__ == '__main__':
+    main()
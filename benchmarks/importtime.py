@@ -0,0 +1,111 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+from typing import Dict, Iterator, List, Tuple
+
+import click
+
+import risk.cli
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# every maintenance command of risk.cli is run for real against an empty SQLite database,
+# so what the loaders import at runtime counts too; these two run the bot instead
+SKIP = {"start": "connects to discord", "bench": "runs the bot against fake channels"}
+# what commands with required parameters are run with, relative to the database's directory
+ARGS: Dict[str, List[str]] = {
+    "recompute": ["--season", "0"],
+    "calibrate": ["--season", "0"],
+    "import": ["history.jsonl"],
+    "export": ["--out", "export"],
+    "profile report": ["--directory", "profile"],
+}
+FORBIDDEN = ["discord", "aiohttp", "peewee_async", "aiomysql", "toolz", "risk.client", "risk.command"]
+CONFIG = """database:
+  driver: SQLite
+  schema: risk.db
+"""
+
+
+def commands(group: click.Group, prefix: Tuple[str, ...]=()) -> Iterator[Tuple[str, ...]]:
+    for name, command in sorted(group.commands.items()):
+        if isinstance(command, click.Group):
+            yield from commands(command, prefix + (name,))
+        else:
+            yield prefix + (name,)
+
+
+def command_args(path: Tuple[str, ...]) -> List[str]:
+    name = " ".join(path)
+    command = risk.cli.main
+    for part in path:
+        command = command.commands[part]
+    if name not in ARGS and any(param.required for param in command.params):
+        raise SystemExit(f"`risk {name}` has required parameters, add what to run it with to ARGS")
+    return list(path) + ARGS.get(name, [])
+
+
+def run(args: List[str], directory: str) -> str:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "from risk.cli import main; main()", *args],
+        capture_output=True, text=True, cwd=directory, env={**os.environ, "PYTHONPATH": ROOT},
+    )
+    if result.returncode:
+        raise SystemExit(f"`risk {' '.join(args)}` failed:\n{result.stderr[-2000:]}")
+    return result.stderr
+
+
+def importtime(args: List[str], directory: str) -> Tuple[float, Dict[str, float]]:
+    # cumulative microseconds of every top level import, as reported by -X importtime
+    loaded = {}
+    total = 0.0
+    for line in run(args, directory).splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        loaded[name.strip()] = int(cumulative) / 1e6
+        if not name.startswith("  "):
+            total += int(cumulative) / 1e6
+    return total, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fail when a maintenance command imports too much or too slowly")
+    parser.add_argument('--budget', type=float, default=0.5, help="Seconds allowed for imports per command")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per command, the fastest counts")
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "config.yaml"), "w") as fp:
+            fp.write(CONFIG)
+        open(os.path.join(directory, "history.jsonl"), "w").close()
+        run(["install"], directory)
+        print(f"{'command':<16} {'imports':>9}  slowest")
+        checks = [("--help", ["--help"])] + [
+            (" ".join(path), command_args(path)) for path in commands(risk.cli.main) if path[0] not in SKIP
+        ]
+        for label, command in checks:
+            runs = [importtime(command, directory) for _ in range(args.repeat)]
+            total, loaded = min(runs, key=lambda result: result[0])
+            slowest = sorted(((t, name) for name, t in loaded.items() if "." not in name), reverse=True)[:3]
+            print(f"{label:<16} {total * 1000:>7.1f}ms  "
+                  + ", ".join(f"{name} {t * 1000:.0f}ms" for t, name in slowest))
+            forbidden = [name for name in FORBIDDEN if name in loaded]
+            if forbidden:
+                print(f"  imports {', '.join(forbidden)}")
+                failed = True
+            if total > args.budget:
+                print(f"  over the {args.budget * 1000:.0f}ms budget")
+                failed = True
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from collections import defaultdict
+from itertools import count
+from typing import Dict, List
+
+from risk.model.database import *
+from risk.metrics import query_count
+from risk.sqlite import SqliteManager, load_sqlite
+import risk.schema
+
+
+FORMATS = [
+    {"id": "1v1", "team_size": 1, "min_player": 2, "max_player": 2},
+    {"id": "3v3", "team_size": 3, "min_player": 6, "max_player": 6},
+    {"id": "5v5", "team_size": 5, "min_player": 10, "max_player": 10},
+]
+
+
+class FakeGuild:
+
+    def __init__(self, id: int):
+        self.id = id
+
+
+class FakeUser:
+
+    def __init__(self, id: int, name: str):
+        self.id = id
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeSent:
+
+    def __init__(self, content: str):
+        self.content = content
+
+    async def edit(self, content: str=None, **kwargs):
+        self.content = content
+
+
+class FakeTyping:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeChannel:
+
+    def __init__(self, id: int, guild: FakeGuild):
+        self.id = id
+        self.guild = guild
+        self.sent: List[FakeSent] = []
+
+    async def send(self, content: str=None, **kwargs) -> FakeSent:
+        sent = FakeSent(content)
+        self.sent.append(sent)
+        return sent
+
+    def typing(self) -> FakeTyping:
+        return FakeTyping()
+
+
+class FakeMessage:
+    ids = count(1)
+
+    def __init__(self, author: FakeUser, channel: FakeChannel, content: str, mentions: List[FakeUser]=()):
+        self.id = next(self.ids)
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.mentions = list(mentions)
+
+
+class Recorder:
+
+    def __init__(self):
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.queries: Dict[str, List[int]] = defaultdict(list)
+
+    async def run(self, client, message: FakeMessage):
+        name = message.content.split()[0]
+        counter = [0]
+        token = query_count.set(counter)
+        start = time.perf_counter()
+        try:
+            await client.on_message(message)
+        finally:
+            self.latency[name].append(time.perf_counter() - start)
+            self.queries[name].append(counter[0])
+            query_count.reset(token)
+
+    def report(self, elapsed: float) -> str:
+        total = sum(len(v) for v in self.latency.values())
+        lines = [f"{'command':<10} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8}"]
+        for name in sorted(self.latency):
+            latency = sorted(self.latency[name])
+            queries = self.queries[name]
+            lines.append(
+                f"{name:<10} {len(latency):>7} {percentile(latency, 50) * 1000:>9.2f} "
+                f"{percentile(latency, 95) * 1000:>9.2f} {percentile(latency, 99) * 1000:>9.2f} "
+                f"{sum(queries) / len(queries):>8.2f}"
+            )
+        lines.append(f"{total} commands in {elapsed:.2f}s, {total / elapsed:.1f} commands/s")
+        return "\n".join(lines)
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+def setup_database(path: str, readers: int=4) -> SqliteManager:
+    db = load_sqlite(path)
+    db.bind(risk.schema.MODELS)
+    risk.schema.migrate(db)
+    with db.atomic():
+        Setting.insert_many([
+            {"key": "match.season", "value": "0"},
+            {"key": "discord.game", "value": "bench"},
+        ]).on_conflict_ignore().execute()
+        MatchFormat.insert_many(FORMATS).on_conflict_ignore().execute()
+    # the setup connection belongs to this thread, the manager opens its own
+    db.close()
+    return SqliteManager(db, readers)
+
+
+async def lobby_cycle(client, recorder: Recorder, channel: FakeChannel, users: List[FakeUser],
+                      match_format: MatchFormat, extra: int, rng: random.Random):
+    creator, players = users[0], users[1:]
+    await recorder.run(client, FakeMessage(creator, channel, f"!create {match_format.id}"))
+    # everyone piles in at once, `extra` of them too late for a place
+    joins = players[:match_format.max_player - 1 + extra]
+    await asyncio.gather(*(recorder.run(client, FakeMessage(user, channel, "!join")) for user in joins))
+    await recorder.run(client, FakeMessage(creator, channel, "!start"))
+    reporter = rng.choice(users[:match_format.max_player])
+    await recorder.run(client, FakeMessage(reporter, channel, f"!confirm {rng.randint(1, 2)}"))
+
+
+async def bench(channels: int=4, rounds: int=5, match_format: str="5v5", extra: int=2, database: str=None,
+                workers: int=2, seed: int=0, readers: int=4) -> str:
+    with tempfile.TemporaryDirectory() as directory:
+        manager = setup_database(database or os.path.join(directory, "bench.db"), readers)
+        try:
+            return await run(manager, channels, rounds, match_format, extra, workers, seed)
+        finally:
+            manager.close()
+
+
+async def run(manager: SqliteManager, channels: int, rounds: int, match_format: str, extra: int, workers: int,
+              seed: int) -> str:
+    import risk.client
+
+    client = risk.client.Client({"balance": {"workers": workers}}, manager)
+    client.command.writer.start()
+    await client.command.lobbies.load(client.command.cache)
+    match_format = await client.command.cache.get(MatchFormat, match_format)
+
+    rng = random.Random(seed)
+    per_channel = match_format.max_player + extra
+    groups = []
+    for n in range(channels):
+        channel = FakeChannel(1000 + n, FakeGuild(1))
+        users = [FakeUser(n * per_channel + m + 1, f"user{n * per_channel + m + 1}") for m in range(per_channel)]
+        groups.append((channel, users))
+
+    recorder = Recorder()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await asyncio.gather(*(
+            lobby_cycle(client, recorder, channel, rng.sample(users, len(users)), match_format, extra, rng)
+            for channel, users in groups
+        ))
+    await client.command.writer.flush()
+    await client.command.outbox.drain()
+    elapsed = time.perf_counter() - start
+    client.executor.shutdown()
+    return recorder.report(elapsed)
@@ -0,0 +1,88 @@
+import time
+
+from collections import OrderedDict, Counter
+from typing import Dict, Hashable
+
+from risk.manager import Manager
+
+
+class Cache:
+
+    def __init__(self, size: int=1024, ttl: float=300):
+        self.size = size
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class ModelCache:
+    # write-through cache for rows looked up by primary key (User, Setting, MatchFormat)
+
+    def __init__(self, database: Manager, size: int=1024, ttl: float=300):
+        self.database = database
+        self.cache = Cache(size, ttl)
+        self.hits = Counter()
+        self.misses = Counter()
+
+    @staticmethod
+    def key(model, pk):
+        return model.__name__, str(pk)
+
+    def lookup(self, model, pk):
+        instance = self.cache.get(self.key(model, pk))
+        if instance is None:
+            self.misses[model.__name__] += 1
+        else:
+            self.hits[model.__name__] += 1
+        return instance
+
+    async def get(self, model, pk):
+        instance = self.lookup(model, pk)
+        if instance is None:
+            instance = await self.database.get_or_none(model, model._meta.primary_key == pk)
+            if instance is not None:
+                self.cache.set(self.key(model, pk), instance)
+        return instance
+
+    async def create_or_get(self, model, **kwargs):
+        pk = kwargs[model._meta.primary_key.name]
+        instance = self.lookup(model, pk)
+        if instance is None:
+            instance = (await self.database.create_or_get(model, **kwargs))[0]
+            self.cache.set(self.key(model, pk), instance)
+        return instance
+
+    async def update(self, instance, only=None):
+        await self.database.update(instance, only=only)
+        self.cache.set(self.key(type(instance), instance.get_id()), instance)
+
+    def invalidate(self, model, pk):
+        self.cache.invalidate(self.key(model, pk))
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            name: {"hits": self.hits[name], "misses": self.misses[name]}
+            for name in sorted(set(self.hits) | set(self.misses))
+        }
@@ -1,7 +1,6 @@
 import click
 
-from risk.util import load_config, load_db, load_async_db
-from risk.model.database import *
+# every command imports what it needs itself, `risk install` shouldn't load discord or numpy
 
 
 @click.group()
@@ -12,17 +11,23 @@ def main():
 @main.command()
 def start():
     import risk.client
+    from risk.util import load_config, load_async_db, load_trueskill
 
     config = load_config("config.yaml")
+    load_trueskill(config)
     db = load_async_db(config)
     risk.client.main(config, db)
 
 
 @main.command()
 def install():
+    import risk.schema
+    from risk.model.database import Setting, User
+    from risk.util import load_config, load_db
+
     config = load_config("config.yaml")
     db = load_db(config)
-    db.create_tables([User, Setting, Match, MatchFormat, MatchLobby, MatchLobbyPlayer, MatchPlayer, Score])
+    risk.schema.migrate(db)
     try:
         User._schema.create_foreign_key(User.updated_by)
     except:
@@ -33,3 +38,210 @@ def install():
     ]
     with db.atomic():
         Setting.insert(settings).on_conflict_ignore().execute()
+
+
+@main.command()
+@click.option('--season', type=int, required=True, help="Season to replay")
+@click.option('--format', 'match_format', default=None, help="Only replay this MatchFormat")
+@click.option('--chunk', type=int, default=1000, help="Matches read per query")
+def recompute(season, match_format, chunk):
+    import time
+    import risk.recompute
+    from risk.util import load_config, load_db, load_trueskill
+
+    config = load_config("config.yaml")
+    load_trueskill(config)
+    db = load_db(config)
+    start = time.perf_counter()
+    for name, players in risk.recompute.recompute(db, season, match_format, chunk):
+        click.echo(f"{name}: {players} players rated")
+    click.echo(f"recomputed season {season} in {time.perf_counter() - start:.2f}s")
+    click.echo("use `!reload` or restart the bot to pick up the new ratings")
+
+
+@main.command()
+@click.option('--check', is_flag=True, help="Fail if a hot query still needs a full table scan")
+def migrate(check):
+    import risk.schema
+    from risk.util import load_config, load_db
+
+    config = load_config("config.yaml")
+    db = load_db(config)
+    for change in risk.schema.migrate(db):
+        click.echo(change)
+    if check:
+        scans = risk.schema.check(db)
+        for name, plans in scans.items():
+            click.echo(f"full scan in `{name}`: {'; '.join(plans)}", err=True)
+        if scans:
+            raise SystemExit(1)
+        click.echo(f"{len(risk.schema.HOT_QUERIES)} hot queries use indexes")
+
+
+@main.command()
+@click.option('--channels', type=int, default=4, help="Lobbies running at the same time")
+@click.option('--rounds', type=int, default=5, help="Lobbies created per channel")
+@click.option('--format', 'match_format', default="5v5", help="MatchFormat to play")
+@click.option('--extra', type=int, default=2, help="Players per channel who try to join a full lobby")
+@click.option('--database', default=None, help="SQLite file to run against, a temporary one by default")
+@click.option('--workers', type=int, default=2, help="Balance worker processes")
+@click.option('--readers', type=int, default=4, help="SQLite reader threads")
+@click.option('--seed', type=int, default=0)
+def bench(channels, rounds, match_format, extra, database, workers, readers, seed):
+    import asyncio
+    import risk.bench
+
+    report = asyncio.get_event_loop().run_until_complete(
+        risk.bench.bench(channels, rounds, match_format, extra, database, workers, seed, readers)
+    )
+    click.echo(report)
+
+
+@main.command()
+@click.option('--out', default="export", help="Directory to write to, partitioned by season and format")
+@click.option('--format', 'file_format', type=click.Choice(["parquet", "arrow", "csv"]), default="parquet",
+              help="parquet and arrow need pyarrow, csv is written without it")
+@click.option('--incremental', is_flag=True, help="Only export matches closed since the last export")
+@click.option('--season', type=int, default=None, help="Only export this season")
+@click.option('--chunk', type=int, default=10000, help="Rows read per query")
+def export(out, file_format, incremental, season, chunk):
+    import risk.export
+    from risk.util import load_config, load_db
+
+    config = load_config("config.yaml")
+    load_db(config)
+    for partition_season, match_format, matches, players, scores in risk.export.export(
+        out, file_format, incremental, chunk, season
+    ):
+        click.echo(f"season {partition_season} {match_format}: {matches} matches, {players} players, {scores} scores")
+
+
+@main.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--season', type=int, default=None, help="Season to import into, the current one by default")
+@click.option('--format', 'match_format', default=None, help="MatchFormat for matches that don't name one")
+@click.option('--batch', type=int, default=5000, help="Matches built and written at a time")
+def import_history(path, season, match_format, batch):
+    import time
+    import risk.importer
+    from risk.model.database import Setting
+    from risk.util import load_config, load_db, load_trueskill
+
+    config = load_config("config.yaml")
+    load_trueskill(config)
+    db = load_db(config)
+    if season is None:
+        season = int(Setting.get(Setting.key == 'match.season').value)
+    read = risk.importer.read_csv if path.endswith(".csv") else risk.importer.read_jsonl
+    start = time.perf_counter()
+    with open(path, newline="") as fp:
+        matches, users = risk.importer.import_matches(db, read(fp, match_format), season, batch)
+    click.echo(f"imported {matches} matches and {users} new users into season {season} "
+               f"in {time.perf_counter() - start:.2f}s")
+    click.echo("use `!reload` or restart the bot to pick up the new ratings")
+
+
+@main.command()
+@click.option('--season', type=int, required=True, help="Season to replay")
+@click.option('--format', 'match_format', default=None, help="Only replay this MatchFormat")
+@click.option('--beta', default=None, help="Comma separated values to try, around the configured one by default")
+@click.option('--tau', default=None, help="Comma separated values to try, around the configured one by default")
+@click.option('--samples', type=int, default=200, help="Simulated seasons for the expected scores")
+@click.option('--chunk', type=int, default=1000, help="Matches read per query")
+def calibrate(season, match_format, beta, tau, samples, chunk):
+    import time
+    import numpy as np
+    import trueskill
+    import risk.recompute
+    from risk.model import predict
+    from risk.util import load_config, load_db, load_trueskill
+
+    config = load_config("config.yaml")
+    current = load_trueskill(config)
+    db = load_db(config)
+    betas = [float(v) for v in beta.split(",")] if beta else [current.beta * f for f in (0.5, 0.75, 1, 1.5, 2)]
+    taus = [float(v) for v in tau.split(",")] if tau else [current.tau * f for f in (0, 0.5, 1, 2, 4)]
+    for name in ([match_format] if match_format else risk.recompute.formats(season)):
+        # read once, every setting replays the same matches
+        matches = list(risk.recompute.stream(season, name, chunk))
+        click.echo(f"{name}: {len(matches)} matches")
+        click.echo(f"{'beta':>8} {'tau':>8} {'brier':>8} {'expected':>15} {'log loss':>9} {'expected':>15}")
+        results = []
+        for b in betas:
+            for t in taus:
+                start = time.perf_counter()
+                env = trueskill.TrueSkill(current.mu, current.sigma, b, t, current.draw_probability)
+                odds, winners, skipped = predict.replay(matches, env, risk.recompute.baseline(season, name, env))
+                result = predict.calibration(odds, winners, skipped, samples, rng=np.random.default_rng(0))
+                results.append((result.log_loss, b, t, result))
+                # a score well above its expected range means the odds are off for these settings
+                brier, log_loss = result.expected_brier, result.expected_log_loss
+                mark = " *" if (b, t) == (current.beta, current.tau) else ""
+                click.echo(
+                    f"{b:>8.3f} {t:>8.4f} {result.brier:>8.4f} {brier[0]:>8.4f}±{brier[1]:.4f}"
+                    f" {result.log_loss:>9.4f} {log_loss[0]:>8.4f}±{log_loss[1]:.4f}"
+                    f" {time.perf_counter() - start:>5.2f}s{mark}"
+                )
+        if not results or not results[0][3].matches:
+            continue
+        _, b, t, result = min(results, key=lambda r: r[0])
+        click.echo(f"best log loss with beta {b:.3f} and tau {t:.4f}, {result.skipped} draws left out")
+        click.echo(f"{'predicted':>10} {'observed':>9} {'teams':>7}")
+        for predicted, observed, count in result.bins:
+            click.echo(f"{predicted:>10.3f} {observed:>9.3f} {count:>7}")
+
+
+@main.group()
+def season():
+    pass
+
+
+def archive_history(db, batch):
+    import risk.season
+
+    current = risk.season.current_season()
+    lobbies = [sum(counts) for counts in zip((0, 0), *risk.season.archive_lobbies(db, batch))]
+    click.echo(f"archived {lobbies[0]} closed lobbies with {lobbies[1]} players")
+    matches = [sum(counts) for counts in zip((0, 0), *risk.season.archive_matches(db, current, batch))]
+    click.echo(f"archived {matches[0]} closed matches of seasons before {current} with {matches[1]} players")
+
+
+@season.command()
+@click.option('--to', 'new_season', type=int, default=None, help="Season to start, the next one by default")
+@click.option('--batch', type=int, default=1000, help="Lobbies or matches moved per transaction")
+def rollover(new_season, batch):
+    import risk.season
+    from risk.util import load_config, load_db
+
+    config = load_config("config.yaml")
+    db = load_db(config)
+    previous, new_season, carried = risk.season.rollover(db, new_season)
+    click.echo(f"season {previous} is over, season {new_season} starts with {carried} scores carried forward")
+    archive_history(db, batch)
+    click.echo("restart the bot to pick up the new season")
+
+
+@season.command()
+@click.option('--batch', type=int, default=1000, help="Lobbies or matches moved per transaction")
+def archive(batch):
+    # what rollover moves, for finishing an interrupted one or archiving matches
+    # that were still open during it
+    from risk.util import load_config, load_db
+
+    config = load_config("config.yaml")
+    db = load_db(config)
+    archive_history(db, batch)
+
+
+@main.group()
+def profile():
+    pass
+
+
+@profile.command()
+@click.option('--directory', default="profile", help="Where the bot writes its profiles")
+@click.option('--top', type=int, default=20, help="Entries per section")
+def report(directory, top):
+    import risk.profiling
+
+    click.echo(risk.profiling.report(directory, top))
@@ -1,8 +1,22 @@
+import asyncio
 import discord
+import logging
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import List
 
 from risk.model.database import *
+from risk.model.match import MatchCreator, Team, balance_teams
+from risk.model.rating import RatingStore
 from risk.command import Command
-from risk.util import Manager
+from risk.matchmaking import Matchmaker
+from risk.metrics import metrics
+from risk.profiling import profiler
+from risk.manager import Manager
+
+
+log = logging.getLogger(__name__)
 
 
 class Client(discord.Client):
@@ -11,9 +25,29 @@ class Client(discord.Client):
         self.config = config
         self.database: Manager = database
         self.command = Command(self, self.config, self.database)
+        balance = self.config.get('balance') or {}
+        self.executor = ProcessPoolExecutor(max_workers=balance.get('workers'))
+        self.balance_timeout = balance.get('timeout', 5)
+        self.matchmaker = Matchmaker(**(self.config.get('matchmaking') or {}))
+        self.scheduler: asyncio.Task = None
+        self.metrics = metrics
+        self.profiler = profiler
+        profiling = dict(self.config.get('profiling') or {})
+        self.profiling = profiling.pop('enabled', None) or []
+        self.profiler.configure(**profiling)
+        self.exporters: List = []
         super().__init__()
 
     async def on_ready(self):
+        self.command.writer.start()
+        await self.command.lobbies.load(self.command.cache)
+        await self.command.ratings.load(await self.command.get_season())
+        if not self.scheduler:
+            self.scheduler = asyncio.ensure_future(self.matchmaking())
+        if not self.exporters:
+            await self.start_metrics()
+            for kind in self.profiling:
+                self.profiler.enable(kind)
         game = await self.database.get(Setting, Setting.key == 'discord.game')
         await self.change_presence(activity=discord.Game(game.value))
         print('Logged in as')
@@ -29,7 +63,65 @@ class Client(discord.Client):
         if message.content.startswith('!'):
             command = message.content.split()[0][1:]
             if hasattr(self.command, f"command_{command}"):
-                await getattr(self.command, f"command_{command}")(message)
+                with self.metrics.command(command), self.profiler.command(command):
+                    await getattr(self.command, f"command_{command}")(message)
+
+    async def start_metrics(self):
+        config = self.config.get('metrics') or {}
+        cache = self.command.cache
+        self.exporters.append(asyncio.ensure_future(self.metrics.watch_loop(config.get('lag_interval', 0.5))))
+        if config.get('port'):
+            self.exporters.append(
+                await self.metrics.serve(config['port'], config.get('host', '127.0.0.1'), cache=cache)
+            )
+        if config.get('file'):
+            self.exporters.append(
+                asyncio.ensure_future(self.metrics.write(config['file'], config.get('interval', 15), cache=cache))
+            )
+
+    async def matchmaking(self):
+        while True:
+            await asyncio.sleep(self.matchmaker.interval)
+            matches = []
+            for match_format, group in self.matchmaker.pop():
+                matched = [entry for entry in group if not await self.command.get_active_match(entry.score.player_id)]
+                # no await from here on until the players are marked, `!join` checks the same
+                matched = [entry for entry in matched if self.command.available(entry.score.player_id)]
+                if len(matched) < len(group):
+                    for entry in matched:
+                        self.matchmaker.put(match_format, entry)
+                    continue
+                self.command.creating.update(str(entry.score.player_id) for entry in group)
+                matches.append(self.command.create_match(
+                    group[0].channel, group[0].score.player_id, [entry.score for entry in group], match_format
+                ))
+            for result in await asyncio.gather(*matches, return_exceptions=True):
+                if isinstance(result, Exception):
+                    log.error("matchmaking failed", exc_info=result)
+
+    async def close(self):
+        for exporter in self.exporters:
+            exporter.cancel() if isinstance(exporter, asyncio.Future) else exporter.close()
+        await self.command.writer.flush()
+        await self.command.outbox.drain()
+        await super().close()
+        self.executor.shutdown(wait=False)
+
+    async def run_in_process(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def balance(self, scores: List[MatchLobbyPlayer], match_format: MatchFormat,
+                      ratings: RatingStore=None) -> List[Team]:
+        creator = MatchCreator(scores, match_format, ratings)
+        # the worker gets half the timeout as search budget so it normally answers in time,
+        # a worker that still overruns is left to finish and its result dropped
+        future = self.run_in_process(
+            partial(balance_teams, creator.players, match_format.team_size, timeout=self.balance_timeout / 2)
+        )
+        try:
+            return await asyncio.wait_for(future, self.balance_timeout)
+        except asyncio.TimeoutError:
+            return balance_teams(creator.players, match_format.team_size, limit=0)
 
 
 def main(config, db):
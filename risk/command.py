@@ -1,15 +1,25 @@
 import discord
-try:
-    import cytoolz as toolz
-except ImportError:
-    import toolz
+import logging
 
+from risk.cache import ModelCache
+from risk.leaderboard import Leaderboards, conservative
+from risk.lobby import LobbyManager, LobbyState, LobbyKey, lobby_key
 from risk.model.database import *
-from risk.model.match import MatchCreator
-from risk.util import Manager
+from risk.model.match import DRAW, MatchCalculator, Result, update_scores
+from risk.model.predict import predict
+from risk.model.rating import RatingStore
+from risk.outbox import Outbox
+from risk.prebalance import Prebalancer
+from risk.ratings import Ratings
+from risk.stats import Stats, stats_queries
+from risk.manager import Manager
+from risk.writer import RETRIES, WriteBehind
 
 from datetime import datetime
-from typing import List
+from typing import List, Optional, Set
+
+
+log = logging.getLogger(__name__)
 
 HELP = """```
 Commands:
@@ -17,11 +27,14 @@ Commands:
     !create [MatchFormat] - Create lobby
     !join                 - Join active lobby
     !stats (@Name)        - Stats Player or Self
+    !top [Format] (page)  - Leaderboard
     !close                - Close active lobby
     !confirm (team)       - Confirm winner
     !where                - Current state, in lobby or in game
     !info [MatchNumber]   - Get information on match
     !leave                - Leave active lobby
+    !queue [MatchFormat]  - Queue for an automatic match
+    !dequeue              - Leave the match queue
 Commands (Moderator):
     !close                - Close active lobby
     !kick                 - Kick player from active lobby
@@ -29,6 +42,11 @@ Commands (Admin):
     !enable @Name         - Enable account
     !disable @Name        - Suspend account
     !void @Name           - Suspend account at stats
+    !cache                - Cache hit/miss counters
+    !metrics              - Command latency and query counts
+    !reload               - Reload ratings after risk recompute or risk import
+    !profile (on|off)     - Profiling, (commands|queries|memory) or all
+    !profile snapshot     - Save a memory snapshot
 ```"""
 
 
@@ -38,55 +56,137 @@ class CommandHelper:
         self.client = client
         self.config = config
         self.database: Manager = database
+        cache = self.config.get('cache') or {}
+        self.cache = ModelCache(database, size=cache.get('size', 1024), ttl=cache.get('ttl', 300))
+        writer = self.config.get('writer') or {}
+        self.writer = WriteBehind(
+            database, size=writer.get('size', 200), interval=writer.get('interval', 1.0),
+            retries=writer.get('retries', RETRIES)
+        )
+        self.lobbies = LobbyManager(database, self.writer)
+        self.ratings = Ratings(database)
+        self.leaderboards = Leaderboards(self.ratings)
+        self.prebalancer = Prebalancer(client.balance)
+        # players of matches that are balanced and written but not in the database yet
+        self.creating: Set[str] = set()
+        outbox = self.config.get('outbox') or {}
+        self.outbox = Outbox(
+            interval=outbox.get('interval', 1.0), rate=outbox.get('rate', 5), per=outbox.get('per', 5.0)
+        )
 
     async def register_user(self, user: discord.User) -> User:
-        return (await self.database.create_or_get(User, id=user.id, name=user.name))[0]
+        return await self.cache.create_or_get(User, id=str(user.id), name=user.name)
 
     async def get_season(self):
-        return (await self.database.get(Setting, key='match.season')).value
+        return (await self.cache.get(Setting, 'match.season')).value
+
+    async def get_ratings(self, match_format: MatchFormat) -> RatingStore:
+        return await self.ratings.get(await self.get_season(), match_format.id)
+
+    async def set_disabled(self, message: discord.Message, disabled: bool):
+        author = await self.register_user(message.author)
+        if not author.admin:
+            self.outbox.notice(message.channel, f"<@{message.author.id}> is not an admin")
+            return
+        if not message.mentions:
+            self.outbox.notice(message.channel, f"user not found")
+            return
+        for mention in message.mentions:
+            user = await self.register_user(mention)
+            user.disabled = disabled
+            user.updated = datetime.utcnow()
+            await self.cache.update(user)
+            self.outbox.notice(message.channel, f"<@{user.id}> has been {'disabled' if disabled else 'enabled'}")
 
     async def send_invalid_match_format(self, message):
         results = await self.database.execute(MatchFormat.select(MatchFormat.id))
         formats = ", ".join(f"`{result.id}`" for result in results)
-        await message.channel.send(
-            f"**Invalid MatchFormat**, use `!create [MatchFormat]`, available MatchFormats: {formats}"
+        self.outbox.notice(
+            message.channel, f"**Invalid MatchFormat**, use `!create [MatchFormat]`, available MatchFormats: {formats}"
         )
 
     async def get_active_match(self, user_id) -> Match:
         return await self.database.get_or_none(
             Match.select()
                  .join(MatchPlayer)
-                 .where((MatchPlayer.player_id == user_id) & Match.closed.is_null())
+                 .where((MatchPlayer.player_id == user_id) & is_null(Match.closed))
         )
 
     async def send_invalid_match(self, message) -> bool:
+        if str(message.author.id) in self.creating:
+            self.outbox.notice(
+                message.channel, f"**Invalid Command**, <@{message.author.id}> is in a match that is being created"
+            )
+            return True
         match = await self.get_active_match(message.author.id)
         if match:
-            await message.channel.send(
+            self.outbox.notice(
+                message.channel,
                 f"**Invalid Command**, <@{message.author.id}> is currently in a match [{match.id}],"
                 f" use `!confirm [team]` to reporting winning team"
             )
             return True
         return False
 
-    async def get_active_lobby(self) -> MatchLobby:
-        return await self.database.get_or_none(MatchLobby, MatchLobby.closed.is_null())
+    def send_queued(self, message) -> bool:
+        queue = self.client.matchmaker.queue(message.author.id)
+        if queue:
+            self.outbox.notice(
+                message.channel,
+                f"<@{message.author.id}> is queued for {queue.match_format}, use `!dequeue` to leave the queue first"
+            )
+            return True
+        return False
+
+    def available(self, user_id) -> bool:
+        # neither in a lobby nor in a match that is still being created
+        return str(user_id) not in self.creating and self.lobbies.find(str(user_id)) is None
 
-    async def get_active_lobby_format(self, lobby: MatchLobby=None) -> MatchFormat:
-        if not lobby:
-            lobby = await self.get_active_lobby()
-        return await self.database.get(MatchFormat, id=lobby.format_id)
+    def send_busy(self, message) -> bool:
+        # checked after a command's last await, the player may have queued, joined a lobby
+        # in another channel or been put in a match meanwhile
+        if self.send_queued(message):
+            return True
+        if str(message.author.id) in self.creating:
+            self.outbox.notice(
+                message.channel, f"**Invalid Command**, <@{message.author.id}> is in a match that is being created"
+            )
+            return True
+        state = self.lobbies.find(str(message.author.id))
+        if state:
+            self.outbox.notice(
+                message.channel,
+                f"<@{message.author.id}> is already in a lobby in <#{state.lobby.channel}>, use `!leave` there first"
+            )
+            return True
+        return False
 
-    async def get_active_match_format(self, match: Match) -> MatchFormat:
-        return await self.database.get(MatchFormat, id=match.format_id)
+    @staticmethod
+    def get_lobby_key(message: discord.Message) -> LobbyKey:
+        return lobby_key(message.guild, message.channel)
 
-    async def get_active_lobby_players(self, lobby: MatchLobby=None) -> List[MatchLobbyPlayer]:
-        if not lobby:
-            lobby = await self.get_active_lobby()
-        results = await self.database.execute(MatchLobbyPlayer.select().where(
-            MatchLobbyPlayer.lobby == lobby
-        ))
-        return list(results)
+    def get_active_lobby(self, key: LobbyKey) -> LobbyState:
+        return self.lobbies.get(key)
+
+    def send_lobby_status(self, channel, state: LobbyState, closed: str=None):
+        # one message per lobby, edited as players come and go
+        match_format = state.match_format
+        players = " ".join(f"<@{player_id}>" for player_id in state.players)
+        content = (f"**{match_format} lobby** ({len(state)}/{match_format.max_player}) "
+                   f"by <@{state.lobby.creator_id}>: {players}")
+        if closed:
+            content += f"\n{closed}"
+        elif len(state) >= match_format.min_player:
+            content += f"\n<@{state.lobby.creator_id}> can `!start`"
+        else:
+            content += f"\ntype `!join` to queue up"
+        self.outbox.status(state, channel, content, final=bool(closed))
+
+    def send_no_lobby(self, channel):
+        self.outbox.notice(channel, f"no lobby active, use `!create [MatchFormat]`")
+
+    async def get_active_match_format(self, match: Match) -> MatchFormat:
+        return await self.cache.get(MatchFormat, match.format_id)
 
     async def get_active_match_players(self, match: Match) -> List[MatchPlayer]:
         results = await self.database.execute(MatchPlayer.select().where(
@@ -94,19 +194,150 @@ class CommandHelper:
         ))
         return list(results)
 
+    async def create_match(self, channel, creator_id, match_players: List[MatchLobbyPlayer],
+                           match_format: MatchFormat) -> Match:
+        # taken before the first await, the lobby lock is already released when this runs
+        players = {str(player.player_id) for player in match_players}
+        self.creating.update(players)
+        written = None
+        try:
+            # the announcement is a status message of its own, edited once the match is written
+            status = object()
+            self.outbox.status(status, channel, 'Creating game...')
+            with channel.typing():
+                ratings = await self.get_ratings(match_format)
+                teams = await self.prebalancer.get(match_players, match_format, ratings)
+                season = await self.get_season()
+                match = Match(creator=creator_id, season=season, format=match_format)
+                self.writer.insert(match)
+                self.writer.insert_many(MatchPlayer, [
+                    {"match": match, "player": player.id, "team": team.team, "mu": player.mu,
+                     "sigma": player.sigma, "games": player.games}
+                    for team in teams for player in team.players
+                ])
+                written = self.writer.written()
+                # players must be seen in their match before anyone is told about it
+                try:
+                    await self.writer.flush()
+                except Exception:
+                    log.exception("writing match failed")
+                if not written.done():
+                    # the writes stay queued, the background flush keeps trying them; also when
+                    # it had taken them and failed while this flush waited for it
+                    self.outbox.status(
+                        status, channel,
+                        "**Match could not be saved yet**, it is retried in the background, "
+                        "`!confirm` works once it is",
+                        final=True
+                    )
+                    raise Exception("writing match failed, it is retried in the background")
+                if not written.result():
+                    self.outbox.status(
+                        status, channel, "**Match could not be saved**, `!create` a new lobby", final=True
+                    )
+                    raise Exception("writing match failed, the writer set it aside")
+                msg = f"**Match [{match.id}]**"
+                for team, odds in zip(teams, predict(teams, ratings.env)):
+                    msg += f"\nTeam [{team.team+1}] ({odds:.0%}): "
+                    for player in team.players:
+                        msg += f"<@{player.id}> "
+                self.outbox.status(status, channel, msg, final=True)
+        finally:
+            if written and not written.done():
+                # the players stay busy until the background flush wrote their match or gave up on it
+                written.add_done_callback(lambda _: self.creating.difference_update(players))
+            else:
+                self.creating.difference_update(players)
+        return match
+
     async def get_score(self, user: User, match_format: MatchFormat):
+        season = await self.get_season()
         score = await self.database.get_or_none(
-            Score, Score.player == user and Score.format == match_format
+            Score, (Score.player == user) & (Score.season == season) & (Score.format == match_format)
         )
         if not score:
-            score = await self.database.create(Score, player=user, format=match_format)
+            score = await self.database.create(Score, player=user, season=season, format=match_format)
         return score
 
+    async def close_match(self, match: Match, match_players: List[MatchPlayer], winner: int,
+                          user: User) -> Optional[List[Result]]:
+        # one UPDATE for the match and one for every Score row of it, whatever the player count;
+        # None when another `!confirm` closed the match first
+        results = MatchCalculator(match_players, winner).rate()
+        now = datetime.utcnow()
+        async with self.database.atomic():
+            closed = await self.database.execute(
+                Match.update(winner=winner, closed=now, updated=now, updated_by=user)
+                     .where((Match.id == match.id) & is_null(Match.closed))
+            )
+            if not closed:
+                return None
+            match.winner, match.closed, match.updated, match.updated_by = winner, now, now, user
+            await self.database.execute(update_scores(results, match.season, match.format_id))
+            rows = await self.database.execute(
+                PlayerStats.select().where(PlayerStats.player.in_([result.id for result in results]))
+            )
+            for query in stats_queries(rows, results, match.id, match.season, match.format_id):
+                await self.database.execute(query)
+        self.ratings.update(match.season, match.format_id, results)
+        self.leaderboards.update(match.season, match.format_id, results)
+        return results
+
 
 class Command(CommandHelper):
 
     async def command_help(self, message: discord.Message):
-        await message.channel.send(HELP)
+        self.outbox.notice(message.channel, HELP)
+
+    async def command_enable(self, message: discord.Message):
+        await self.set_disabled(message, False)
+
+    async def command_disable(self, message: discord.Message):
+        await self.set_disabled(message, True)
+
+    async def command_cache(self, message: discord.Message):
+        user = await self.register_user(message.author)
+        if user.admin:
+            stats = self.cache.stats()
+            lines = "\n".join(
+                f"{name:<12} {counts['hits']:>8} hits {counts['misses']:>8} misses" for name, counts in stats.items()
+            )
+            self.outbox.notice(message.channel, f"```{lines or 'empty'}```")
+
+    async def command_metrics(self, message: discord.Message):
+        user = await self.register_user(message.author)
+        if user.admin:
+            self.outbox.notice(message.channel, f"```{self.client.metrics.summary()}```")
+
+    async def command_reload(self, message: discord.Message):
+        # ratings written behind the bot's back by `risk recompute` or `risk import`
+        user = await self.register_user(message.author)
+        if user.admin:
+            self.cache.invalidate(Setting, 'match.season')
+            self.ratings.invalidate()
+            self.leaderboards.invalidate()
+            season = await self.get_season()
+            await self.ratings.load(season)
+            self.outbox.notice(message.channel, f"ratings of season {season} reloaded")
+
+    async def command_profile(self, message: discord.Message):
+        user = await self.register_user(message.author)
+        if not user.admin:
+            return
+        command = message.content.split()
+        profiler = self.client.profiler
+        try:
+            if len(command) >= 2 and command[1] in ("on", "off"):
+                for kind in command[2:] or ["commands", "queries", "memory"]:
+                    profiler.enable(kind) if command[1] == "on" else profiler.disable(kind)
+            elif len(command) == 2 and command[1] == "snapshot":
+                self.outbox.notice(message.channel, f"saved {profiler.snapshot()}")
+                return
+        except Exception as e:
+            self.outbox.notice(message.channel, f"{e}")
+            return
+        lines = "\n".join(profiler.status())
+        self.outbox.notice(message.channel, f"```{lines}```")
 
     async def command_spoof(self, message: discord.Message):
         author = await self.register_user(message.author)
@@ -121,178 +352,247 @@ class Command(CommandHelper):
                     if hasattr(self, f"command_{command}"):
                         await getattr(self, f"command_{command}")(message)
                     else:
-                        await message.channel.send("command not found")
+                        self.outbox.notice(message.channel, "command not found")
                 else:
-                    await message.channel.send("user not found")
+                    self.outbox.notice(message.channel, "user not found")
             else:
-                await message.channel.send("user not found")
+                self.outbox.notice(message.channel, "user not found")
 
     async def command_create(self, message: discord.Message):
         if await self.send_invalid_match(message):
             return
-        lobby = await self.get_active_lobby()
-        if lobby:
-            await message.channel.send(f"<@{lobby.creator_id}> has already created a lobby, type `!join` to queue up")
-        else:
-            command = message.content.split()
-            if len(command) == 2:
-                match_format = await self.database.get_or_none(MatchFormat, id=command[1])
-                if match_format:
-                    async with self.database.atomic():
+        key = self.get_lobby_key(message)
+        async with self.lobbies.lock(key):
+            state = self.get_active_lobby(key)
+            if state:
+                self.outbox.notice(
+                    message.channel,
+                    f"<@{state.lobby.creator_id}> has already created a lobby, type `!join` to queue up"
+                )
+            else:
+                command = message.content.split()
+                if len(command) == 2:
+                    match_format = await self.cache.get(MatchFormat, command[1])
+                    if match_format:
                         user = await self.register_user(message.author)
                         score = await self.get_score(user, match_format)
-                        lobby = await self.database.create(MatchLobby, creator=user, format=match_format)
-                        await self.database.create(
-                            MatchLobbyPlayer,
-                            lobby=lobby, player=user, mu=score.mu, sigma=score.sigma, games=score.games
-                        )
-                    await message.channel.send(
-                        f"<@{message.author}> has created a {match_format} lobby, type `!join` to queue up")
+                        # checked after the last await, so `!queue` or another lobby can't slip in between
+                        if not self.send_busy(message):
+                            state = self.lobbies.create(key, user, match_format, score)
+                            self.send_lobby_status(message.channel, state)
+                    else:
+                        await self.send_invalid_match_format(message)
                 else:
                     await self.send_invalid_match_format(message)
-            else:
-                await self.send_invalid_match_format(message)
 
     async def command_close(self, message: discord.Message):
-        lobby = await self.get_active_lobby()
-        if lobby:
-            if (message.author.id == int(lobby.creator_id)) or ((datetime.utcnow() - lobby.updated).seconds > 60):
-                lobby.closed = datetime.utcnow()
-            else:
-                user = await self.register_user(message.author)
-                if user.moderator or user.admin:
-                    lobby.closed = datetime.utcnow()
+        key = self.get_lobby_key(message)
+        async with self.lobbies.lock(key):
+            state = self.get_active_lobby(key)
+            if state:
+                lobby = state.lobby
+                if (str(message.author.id) == lobby.creator_id) or ((datetime.utcnow() - lobby.updated).seconds > 60):
+                    self.lobbies.close(state)
                 else:
-                    await message.channel.send(
-                        f"<@{lobby.creator_id}> has already created a lobby, can't be closed currently"
-                    )
-            if lobby.closed:
-                lobby.updated = datetime.utcnow()
-                await self.database.update(lobby)
-                await message.channel.send(
-                    f"<@{message.author.id}> closed the lobby"
-                )
-        else:
-            await message.channel.send(f"no lobby active, use `!create [MatchFormat]`")
+                    user = await self.register_user(message.author)
+                    if user.moderator or user.admin:
+                        self.lobbies.close(state)
+                    else:
+                        self.outbox.notice(
+                            message.channel,
+                            f"<@{lobby.creator_id}> has already created a lobby, can't be closed currently"
+                        )
+                if lobby.closed:
+                    self.prebalancer.cancel(key)
+                    self.send_lobby_status(message.channel, state, f"<@{message.author.id}> closed the lobby")
+            else:
+                self.send_no_lobby(message.channel)
 
     async def command_join(self, message: discord.Message):
         if await self.send_invalid_match(message):
             return
-        lobby = await self.get_active_lobby()
-        if lobby:
-            match_format = await self.get_active_lobby_format(lobby)
-            match_players = await self.get_active_lobby_players(lobby)
-            user = await self.register_user(message.author)
-            if len(match_players) >= match_format.max_player:
-                await message.channel.send(f"lobby is currently full, <@{lobby.creator_id}> `!start`")
-            elif not user.disabled:
-                if toolz.count(filter(lambda x: x.player_id == user.id, match_players)):
-                    await message.channel.send(f"you are already signed up for the current lobby")
-                else:
-                    lobby.updated = datetime.utcnow()
-                    async with self.database.atomic():
-                        score = await self.get_score(user, match_format)
-                        await self.database.create(
-                            MatchLobbyPlayer,
-                            lobby=lobby, player=user, mu=score.mu, sigma=score.sigma, games=score.games
-                        )
-                        lobby.updated = datetime.utcnow()
-                        await self.database.update(lobby)
-                    if len(match_players) + 1 >= match_format.min_player:
-                        await message.channel.send(
-                            f"<@{user.id}> has joined the lobby ({len(match_players) + 1}/{match_format.max_player}), "
-                            f"<@{lobby.creator_id}> can `!start`"
+        key = self.get_lobby_key(message)
+        async with self.lobbies.lock(key):
+            state = self.get_active_lobby(key)
+            if state:
+                match_format = state.match_format
+                user = await self.register_user(message.author)
+                if state.full:
+                    self.outbox.notice(
+                        message.channel, f"lobby is currently full, <@{state.lobby.creator_id}> `!start`"
+                    )
+                elif not user.disabled:
+                    if user.id in state:
+                        self.outbox.notice(
+                            message.channel, f"<@{user.id}> you are already signed up for the current lobby"
                         )
                     else:
-                        await message.channel.send(
-                            f"<@{user.id}> has joined the lobby ({len(match_players) + 1}/{match_format.max_player})"
-                        )
-        else:
-            await message.channel.send(f"no lobby active, use `!create [MatchFormat]`")
+                        score = await self.get_score(user, match_format)
+                        if self.send_busy(message):
+                            return
+                        self.lobbies.join(state, user, score)
+                        self.prebalancer.update(state, await self.get_ratings(match_format))
+                        self.send_lobby_status(message.channel, state)
+                        if len(state) == match_format.min_player:
+                            # edits don't notify, the creator gets pinged once
+                            self.outbox.notice(message.channel, f"<@{state.lobby.creator_id}> can `!start`")
+            else:
+                self.send_no_lobby(message.channel)
 
     async def command_start(self, message: discord.Message):
-        lobby = await self.get_active_lobby()
-        if lobby and lobby.creator_id == message.author.id:
-            match_format = await self.get_active_lobby_format(lobby)
-            match_players = await self.get_active_lobby_players(lobby)
-            if len(match_players) >= match_format.max_player:
-                tmp = await message.channel.send('Creating game...')
-                with message.channel.typing():
-                    creator = MatchCreator(match_players, match_format)
-                    teams = creator.balance()
-                    async with self.database.atomic():
-                        season = await self.get_season()
-                        match = await self.database.create(
-                            Match, creator=lobby.creator_id, season=season, format=match_format
-                        )
-                        msg = f"**Match [{match.id}]**"
-                        for team in teams:
-                            msg += f"\nTeam [{team.team+1}]: "
-                            for player in team.players:
-                                msg += f"<@{player.id}> "
-                                await self.database.create(
-                                    MatchPlayer,
-                                    match=match, player_id=player.id, team=team.team, mu=player.mu,
-                                    sigma=player.sigma, games=player.games
-                                )
-                        lobby.closed = datetime.utcnow()
-                        await self.database.update(lobby)
-                    await tmp.edit(content=msg)
+        key = self.get_lobby_key(message)
+        async with self.lobbies.lock(key):
+            state = self.get_active_lobby(key)
+            if state and state.lobby.creator_id == str(message.author.id):
+                if state.full:
+                    self.lobbies.close(state)
+                    self.send_lobby_status(message.channel, state, f"started by <@{message.author.id}>")
+                else:
+                    self.outbox.notice(message.channel, f"lobby has not minimum player requirement "
+                                                        f"({len(state)}/{state.match_format.min_player})")
+            elif state:
+                self.outbox.notice(message.channel, f"lobby must be confirmed by <@{state.lobby.creator_id}>")
             else:
-                await message.channel.send(f"lobby has not minimum player requirement "
-                                           f"({len(match_players)}/{match_format.min_player})")
-        elif lobby.creator_id != message.author.id:
-            await message.channel.send(f"lobby must be confirmed by @<{lobby.creator_id}>")
+                self.send_no_lobby(message.channel)
+        # balancing and writing the match happen outside the lock, the lobby is already closed
+        if state and state.lobby.closed:
+            await self.create_match(
+                message.channel, state.lobby.creator_id, list(state.players.values()), state.match_format
+            )
+
+    async def command_stats(self, message: discord.Message):
+        target = message.mentions[0] if message.mentions else message.author
+        row = await self.database.get_or_none(PlayerStats, PlayerStats.player == str(target.id))
+        if not row:
+            self.outbox.notice(message.channel, f"<@{target.id}> has not played any games yet")
+            return
+        stats = Stats.loads(row.data)
+        season = int(await self.get_season())
+        lines = [f"{'games':<10} {stats.games} ({stats.win}W {stats.lose}L {stats.draw}D), form {stats.recent}"]
+        for match_format, counts in sorted(stats.formats.items()):
+            line = f"{match_format:<10} {counts['win']}W {counts['lose']}L {counts['draw']}D"
+            rating = stats.rating(season, match_format)
+            if rating:
+                board = await self.leaderboards.get(season, match_format)
+                rank = board.rank(target.id)
+                line += f", rating {conservative(*rating):.2f}"
+                line += f" (#{rank}/{len(board)})" if rank else ""
+            lines.append(line)
+        people = [player for player, _ in stats.teammates.most_common(3) + stats.opponents.most_common(3)]
+        names = {
+            user.id: user.name for user in
+            await self.database.execute(User.select().where(User.id.in_(people)))
+        }
+        for label, counter in (("teammates", stats.teammates), ("opponents", stats.opponents)):
+            common = ", ".join(f"{names.get(p, p)} ({n})" for p, n in counter.most_common(3))
+            lines.append(f"{label:<10} {common or '-'}")
+        self.outbox.notice(message.channel, f"**Stats {target.name}**\n```" + "\n".join(lines) + "```")
+
+    async def command_top(self, message: discord.Message):
+        command = message.content.split()
+        match_format = await self.cache.get(MatchFormat, command[1]) if len(command) in (2, 3) else None
+        if match_format:
+            page = int(command[2]) if len(command) == 3 and command[2].isnumeric() else 1
+            board = await self.leaderboards.get(await self.get_season(), match_format.id)
+            page = min(max(page, 1), board.pages)
+            rows = board.page(page)
+            names = {
+                user.id: user.name for user in
+                await self.database.execute(User.select().where(User.id.in_([player for _, player, _ in rows])))
+            }
+            lines = "\n".join(f"{rank:>4}. {names.get(player, player):<24} {rating:>7.2f}" for rank, player, rating in rows)
+            self.outbox.notice(
+                message.channel,
+                f"**{match_format} Leaderboard** (page {page}/{board.pages})\n```{lines or 'no rated players'}```"
+            )
         else:
-            await message.channel.send(f"no lobby active, use `!create [MatchFormat]`")
+            await self.send_invalid_match_format(message)
+
+    async def command_queue(self, message: discord.Message):
+        if await self.send_invalid_match(message):
+            return
+        command = message.content.split()
+        match_format = await self.cache.get(MatchFormat, command[1]) if len(command) == 2 else None
+        if match_format:
+            user = await self.register_user(message.author)
+            if user.disabled:
+                return
+            queue = self.client.matchmaker.queue(user.id)
+            if queue:
+                self.outbox.notice(
+                    message.channel, f"<@{user.id}> is already queued for {queue.match_format}, use `!dequeue` to leave"
+                )
+            else:
+                score = await self.get_score(user, match_format)
+                if not self.available(user.id):
+                    self.outbox.notice(message.channel, f"<@{user.id}> is in a lobby, use `!leave` to queue instead")
+                elif self.client.matchmaker.queue(user.id) is None:
+                    queue = self.client.matchmaker.add(match_format, MatchLobbyPlayer(
+                        player=user, mu=score.mu, sigma=score.sigma, games=score.games
+                    ), message.channel)
+                    self.outbox.notice(
+                        message.channel, f"<@{user.id}> queued for {match_format} ({len(queue)} waiting)"
+                    )
+        else:
+            await self.send_invalid_match_format(message)
+
+    async def command_dequeue(self, message: discord.Message):
+        entry = self.client.matchmaker.remove(message.author.id)
+        if entry:
+            self.outbox.notice(message.channel, f"<@{message.author.id}> left the queue")
+        else:
+            self.outbox.notice(message.channel, f"<@{message.author.id}> isn't queued")
 
     async def command_confirm(self, message: discord.Message):
-        if message.content:
+        command = message.content.split()
+        if len(command) == 2:
             match = await self.get_active_match(message.author.id)
             if match:
                 match_players = await self.get_active_match_players(match)
                 user = await self.register_user(message.author)
-                if match.content.lower() == "draw":
-                    match.closed = datetime.utcnow()
-                    match.updated = datetime.utcnow()
-                    match.updated_by = user
-                    await self.database.update(match)
-                    await message.channel.send(
-                        f"**Match [{match.id}]** resulted in a draw, closed by <@{message.author.id}>"
+                result = command[1].lower()
+                if result == "draw":
+                    if await self.close_match(match, match_players, DRAW, user) is None:
+                        self.outbox.notice(message.channel, f"**Match [{match.id}]** has already been confirmed")
+                        return
+                    self.outbox.notice(
+                        message.channel, f"**Match [{match.id}]** resulted in a draw, closed by <@{message.author.id}>"
+                    )
+                elif result.isnumeric() and int(result) - 1 in map(lambda p: p.team, match_players):
+                    if await self.close_match(match, match_players, int(result) - 1, user) is None:
+                        self.outbox.notice(message.channel, f"**Match [{match.id}]** has already been confirmed")
+                        return
+                    self.outbox.notice(
+                        message.channel,
+                        f"**Match [{match.id}]** won by Team [{result}], confirmed by <@{message.author.id}>"
                     )
-                elif message.content.isnumeric() and int(message.content) in map(lambda p: p.team, match_players):
-                    pass
                 else:
-                    await message.channel.send(
-                        f"**Invalid Team**, use `!confirm [team/draw]` to reporting winning team"
+                    self.outbox.notice(
+                        message.channel, f"**Invalid Team**, use `!confirm [team/draw]` to reporting winning team"
                     )
 
             else:
-                await message.channel.send(f"<@{message.author.id}> not currently in an active match")
+                self.outbox.notice(message.channel, f"<@{message.author.id}> not currently in an active match")
         else:
-            await message.channel.send(
-                f"**Invalid Command**, use `!confirm [team/draw]` to reporting winning team"
+            self.outbox.notice(
+                message.channel, f"**Invalid Command**, use `!confirm [team/draw]` to reporting winning team"
             )
 
     async def command_leave(self, message: discord.Message):
-        lobby = await self.get_active_lobby()
-        if lobby:
-            user = await self.register_user(message.author)
-            if lobby.creator_id == user.id:
-                lobby.closed = datetime.utcnow()
-                lobby.updated = datetime.utcnow()
-                await self.database.update(lobby)
-                await message.channel.send(f"<@{user.id}> closed the lobby")
-            else:
-                match_format = await self.get_active_lobby_format(lobby)
-                match_players = await self.get_active_lobby_players(lobby)
-                if toolz.count(filter(lambda x: x.player_id == user.id, match_players)):
-                    match_player = toolz.first(filter(lambda x: x.player_id == user.id, match_players))
-                    await self.database.delete(match_player)
-                    await message.channel.send(
-                        f"<@{user.id}> has left the lobby ({len(match_players)-1}/{match_format.max_player})"
-                    )
+        key = self.get_lobby_key(message)
+        async with self.lobbies.lock(key):
+            state = self.get_active_lobby(key)
+            if state:
+                user = await self.register_user(message.author)
+                if state.lobby.creator_id == user.id:
+                    self.lobbies.close(state)
+                    self.prebalancer.cancel(key)
+                    self.send_lobby_status(message.channel, state, f"<@{user.id}> closed the lobby")
+                elif user.id in state:
+                    self.lobbies.leave(state, user.id)
+                    self.prebalancer.update(state, await self.get_ratings(state.match_format))
+                    self.send_lobby_status(message.channel, state)
                 else:
-                    await message.channel.send(f"<@{user.id}> isn't in a lobby")
-        else:
-            await message.channel.send(f"no lobby active, use `!create [MatchFormat]`")
+                    self.outbox.notice(message.channel, f"<@{user.id}> isn't in a lobby")
+            else:
+                self.send_no_lobby(message.channel)
@@ -0,0 +1,209 @@
+import csv
+import json
+import logging
+import os
+import peewee
+
+from typing import Iterator, List, Set, Tuple
+
+from risk.model.database import *
+
+
+log = logging.getLogger(__name__)
+
+STATE = "_export.json"
+
+MATCH = [Match.id, Match.creator, Match.winner, Match.closed, Match.created, Match.updated_by]
+MATCH_PLAYER = [
+    MatchPlayer.id, MatchPlayer.match, MatchPlayer.player, MatchPlayer.team, MatchPlayer.mu, MatchPlayer.sigma,
+    MatchPlayer.games,
+]
+SCORE = [Score.id, Score.player, Score.mu, Score.sigma, Score.win, Score.lose, Score.updated]
+# archived matches keep their ids, both tables are written to the same partitions
+HISTORY = [(Match, MatchPlayer), (MatchArchive, MatchPlayerArchive)]
+
+
+def file_format(name: str) -> str:
+    # parquet and arrow need pyarrow, without it everything is written as csv
+    if name != "csv":
+        try:
+            import pyarrow
+        except ImportError:
+            log.warning("pyarrow is not installed, exporting csv")
+            return "csv"
+    return name
+
+
+def columns(fields: List[peewee.Field]) -> List[str]:
+    return [field.column_name for field in fields]
+
+
+def fields(model, template: List[peewee.Field]) -> List[peewee.Field]:
+    return [getattr(model, field.name) for field in template]
+
+
+def keyset(query: peewee.Select, key: peewee.Field, chunk: int, after: int=0) -> Iterator[List[tuple]]:
+    # pages of the query ordered by `key`, which must be the first column, each page
+    # starting after the last key of the one before so no OFFSET scan grows with the table
+    last = after
+    while True:
+        page = list(query.where(key > last).order_by(key).limit(chunk).tuples())
+        if not page:
+            return
+        yield page
+        last = page[-1][0]
+
+
+def arrow_type(field: peewee.Field):
+    # from the field, a page whose column is all NULL would otherwise get a null type that
+    # the other files of the partition don't share
+    import pyarrow
+
+    if isinstance(field, peewee.ForeignKeyField):
+        return arrow_type(field.rel_field)
+    if isinstance(field, peewee.BooleanField):
+        return pyarrow.bool_()
+    if isinstance(field, peewee.IntegerField):
+        return pyarrow.int64()
+    if isinstance(field, peewee.FloatField):
+        return pyarrow.float64()
+    if isinstance(field, peewee.DateTimeField):
+        return pyarrow.timestamp("us")
+    return pyarrow.string()
+
+
+def write(path: str, fields: List[peewee.Field], rows: List[tuple], fmt: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    names = columns(fields)
+    if fmt == "csv":
+        with open(tmp, "w", newline="") as fp:
+            writer = csv.writer(fp)
+            writer.writerow(names)
+            writer.writerows(rows)
+    else:
+        import pyarrow
+
+        schema = pyarrow.schema([(name, arrow_type(field)) for name, field in zip(names, fields)])
+        table = pyarrow.table(dict(zip(names, map(list, zip(*rows)))), schema=schema)
+        if fmt == "parquet":
+            import pyarrow.parquet
+
+            pyarrow.parquet.write_table(table, tmp)
+        else:
+            with pyarrow.ipc.new_file(tmp, table.schema) as writer:
+                writer.write_table(table)
+    os.replace(tmp, path)
+
+
+def partition(out: str, table: str, season: int, match_format: str) -> str:
+    return os.path.join(out, table, f"season={season}", f"format={match_format}")
+
+
+def high_water(newest: int) -> int:
+    # the bookmark of incremental runs stops before the oldest open match, that one is
+    # exported once it is closed; what was exported above the bookmark is kept apart
+    oldest_open = Match.select(peewee.fn.MIN(Match.id)).where(is_null(Match.closed)).scalar()
+    if oldest_open is not None:
+        return min(oldest_open - 1, newest)
+    return newest
+
+
+def load_state(out: str) -> dict:
+    try:
+        with open(os.path.join(out, STATE)) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(out: str, state: dict):
+    tmp = os.path.join(out, f"{STATE}.tmp")
+    with open(tmp, "w") as fp:
+        json.dump(state, fp)
+    os.replace(tmp, os.path.join(out, STATE))
+
+
+def export_matches(out: str, season: int, match_format: str, after: int, upper: int, done: Set[int], chunk: int,
+                   fmt: str) -> Tuple[int, int, List[int]]:
+    # closed matches with ids in (after, upper] not in `done`, gives the counts and the ids written
+    exported = players = 0
+    ids = []
+    for match, match_player in HISTORY:
+        counts = _export_matches(match, match_player, out, season, match_format, after, upper, done, chunk, fmt)
+        exported, players, ids = exported + counts[0], players + counts[1], ids + counts[2]
+    return exported, players, ids
+
+
+def _export_matches(match, match_player, out, season, match_format, after, upper, done, chunk, fmt):
+    # a page of matches and the players of those matches make one file each
+    scope = (match.season == season) & (match.format == match_format)
+    matches = match.select(*fields(match, MATCH)).where(scope & match.closed.is_null(False) & (match.id <= upper))
+    exported = players = 0
+    ids = []
+    for page in keyset(matches, match.id, chunk, after):
+        page = [row for row in page if row[0] not in done]
+        if not page:
+            continue
+        name = f"part-{page[0][0]:012d}.{fmt}"
+        write(os.path.join(partition(out, "match", season, match_format), name), MATCH, page, fmt)
+        written = {row[0] for row in page}
+        rows = [
+            row for row in
+            match_player.select(*fields(match_player, MATCH_PLAYER))
+                        .join(match)
+                        .where(scope & match_player.match.between(page[0][0], page[-1][0]))
+                        .order_by(match_player.id)
+                        .tuples()
+            if row[1] in written
+        ]
+        if rows:
+            write(os.path.join(partition(out, "matchplayer", season, match_format), name), MATCH_PLAYER, rows, fmt)
+        exported += len(page)
+        players += len(rows)
+        ids += sorted(written)
+    return exported, players, ids
+
+
+def export_scores(out: str, season: int, match_format: str, chunk: int, fmt: str) -> int:
+    # scores change in place, every export replaces the partition with a fresh snapshot
+    directory = partition(out, "score", season, match_format)
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+    query = Score.select(*SCORE).where((Score.season == season) & (Score.format == match_format))
+    exported = 0
+    for page in keyset(query, Score.id, chunk):
+        write(os.path.join(directory, f"part-{page[0][0]:012d}.{fmt}"), SCORE, page, fmt)
+        exported += len(page)
+    return exported
+
+
+def export(out: str, fmt: str="parquet", incremental: bool=False, chunk: int=10000,
+           season: int=None) -> Iterator[Tuple[int, str, int, int, int]]:
+    # yields (season, format, matches, match players, scores) for every partition written
+    fmt = file_format(fmt)
+    state = load_state(out) if incremental else {}
+    after = state.get("match", 0)
+    # closed matches above the bookmark that earlier runs exported
+    done = set(state.get("exported", []))
+    upper = Match.select(peewee.fn.MAX(Match.id)).scalar() or 0
+    bookmark = max(after, high_water(upper))
+    exported = set()
+    partitions = set()
+    for match, _ in HISTORY:
+        query = match.select(match.season, match.format).distinct()
+        if season is not None:
+            query = query.where(match.season == season)
+        partitions.update(query.tuples())
+    for partition_season, match_format in sorted(partitions):
+        matches, players, ids = export_matches(
+            out, partition_season, match_format, after, upper, done, chunk, fmt
+        )
+        exported.update(ids)
+        scores = export_scores(out, partition_season, match_format, chunk, fmt)
+        yield partition_season, match_format, matches, players, scores
+    if season is None:
+        os.makedirs(out, exist_ok=True)
+        above = sorted(match for match in done | exported if match > bookmark)
+        save_state(out, {"match": bookmark, "exported": above, "format": fmt})
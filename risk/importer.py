@@ -0,0 +1,200 @@
+import csv
+import datetime
+import json
+import peewee
+
+from itertools import groupby
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from risk.model.database import *
+from risk.model.match import DRAW, Result
+from risk.model.rating import RatingState, RatingStore
+from risk.recompute import write_scores
+from risk.stats import Stats, save_queries
+
+
+BATCH = 500
+
+
+class Record(NamedTuple):
+    timestamp: datetime.datetime
+    match_format: str
+    players: List[str]
+    names: List[Optional[str]]
+    teams: List[int]
+    winner: int
+
+
+def parse_time(value) -> datetime.datetime:
+    if isinstance(value, (int, float)) or str(value).replace(".", "", 1).isdigit():
+        return datetime.datetime.utcfromtimestamp(float(value))
+    timestamp = datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if timestamp.tzinfo:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def parse_winner(value) -> int:
+    # the team number as `!confirm` takes it, counting from 1, or `draw`
+    if str(value).strip().lower() == "draw":
+        return DRAW
+    return int(value) - 1
+
+
+def read_jsonl(lines: Iterable[str], match_format: str=None) -> Iterator[Record]:
+    # {"timestamp": ..., "format": "5v5", "teams": [["id", ...], ...], "winner": 1,
+    #  "names": {"id": "name"}}, one match per line
+    for line in lines:
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        names = row.get("names") or {}
+        players, teams = [], []
+        for team, members in enumerate(row["teams"]):
+            players += [str(member) for member in members]
+            teams += [team] * len(members)
+        yield Record(
+            parse_time(row["timestamp"]), row.get("format") or match_format, players,
+            [names.get(player) for player in players], teams, parse_winner(row["winner"])
+        )
+
+
+def read_csv(lines: Iterable[str], match_format: str=None) -> Iterator[Record]:
+    # one row per player: match,timestamp,format,player,name,team,winner, the rows of a
+    # match next to each other, team and winner counted from 1
+    for _, rows in groupby(csv.DictReader(lines), key=lambda row: row["match"]):
+        rows = list(rows)
+        first = rows[0]
+        yield Record(
+            parse_time(first["timestamp"]), first.get("format") or match_format,
+            [row["player"] for row in rows], [row.get("name") or None for row in rows],
+            [int(row["team"]) - 1 for row in rows], parse_winner(first["winner"])
+        )
+
+
+def chronological(records: Iterator[Record]) -> Iterator[Record]:
+    # ratings are replayed as the file is read, an earlier match after a later one
+    # would be rated in the wrong order
+    last = None
+    for number, record in enumerate(records, 1):
+        if last and record.timestamp < last:
+            raise Exception(f"match {number} at {record.timestamp} is older than the one before it")
+        last = record.timestamp
+        yield record
+
+
+def batches(records: Iterator[Record], size: int) -> Iterator[List[Record]]:
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def seed_state(season: int, match_format: str) -> RatingState:
+    # continue from the ratings already in the season
+    query = Score.select(Score.player, Score.mu, Score.sigma, Score.win, Score.lose).where(
+        (Score.season == season) & (Score.format == match_format)
+    )
+    return RatingStore.from_scores(query.tuples().iterator())
+
+
+def load_stats(stats: Dict[str, Stats], existing: Set[str], players: Iterable[str]):
+    # what !stats shows of the players not seen yet, imported matches are added to it
+    missing = [player for player in set(players) if player not in stats]
+    for start in range(0, len(missing), BATCH):
+        for row in PlayerStats.select().where(PlayerStats.player.in_(missing[start:start + BATCH])):
+            stats[row.player_id] = Stats.loads(row.data)
+            existing.add(row.player_id)
+    for player in missing:
+        stats.setdefault(player, Stats())
+
+
+def insert(db: peewee.Database, model, rows: List[dict]):
+    # building the SQL value by value is most of the time peewee spends on a big
+    # insert_many, so the statement is built once and the rows go through executemany
+    if not rows:
+        return
+    fields = [field for field in model._meta.sorted_fields if field.name in rows[0] or field.default is not None]
+    defaults = {
+        field.name: field.default() if callable(field.default) else field.default
+        for field in fields if field.name not in rows[0]
+    }
+    sql, _ = model.insert_many([{**defaults, **rows[0]}], fields=fields).sql()
+    cursor = db.cursor()
+    for start in range(0, len(rows), BATCH):
+        cursor.executemany(sql, [
+            tuple(field.db_value(row.get(field.name, defaults.get(field.name))) for field in fields)
+            for row in rows[start:start + BATCH]
+        ])
+
+
+def import_matches(db: peewee.Database, records: Iterator[Record], season: int, batch: int=5000) -> Tuple[int, int]:
+    # all or nothing, a bad record late in the file rolls back what came before it
+    # together with the scores, so the fixed file can simply be imported again
+    with db.atomic():
+        return _import_matches(db, records, season, batch)
+
+
+def _import_matches(db, records, season, batch):
+    # match ids are handed out here so MatchPlayer rows can be built without reading
+    # them back, the bot shouldn't be creating matches while this runs
+    formats = {row.id: row for row in MatchFormat.select()}
+    users = {row[0] for row in User.select(User.id).tuples().iterator()}
+    states: Dict[str, RatingState] = {}
+    stats: Dict[str, Stats] = {}
+    existing: Set[str] = set()
+    next_id = (Match.select(peewee.fn.MAX(Match.id)).scalar() or 0) + 1
+    imported = created = 0
+    for records_batch in batches(chronological(records), batch):
+        new_users, matches, players = {}, [], []
+        load_stats(stats, existing, (player for record in records_batch for player in record.players))
+        for record in records_batch:
+            if record.match_format not in formats:
+                raise Exception(f"unknown MatchFormat `{record.match_format}`, available: {', '.join(formats)}")
+            if record.winner != DRAW and record.winner not in record.teams:
+                raise Exception(f"match at {record.timestamp} has no team {record.winner + 1}")
+            for player, name in zip(record.players, record.names):
+                if player not in users:
+                    users.add(player)
+                    new_users[player] = {"id": player, "name": name or player}
+            state = states.get(record.match_format)
+            if state is None:
+                state = states[record.match_format] = seed_state(season, record.match_format)
+            matches.append({
+                "id": next_id, "creator": record.players[0], "season": season, "format": record.match_format,
+                "winner": record.winner, "closed": record.timestamp, "created": record.timestamp,
+                "updated": record.timestamp,
+            })
+            slots = [state.slot(player) for player in record.players]
+            for player, team, slot in zip(record.players, record.teams, slots):
+                players.append({
+                    "match": next_id, "team": team, "player": player, "mu": float(state.mu[slot]),
+                    "sigma": float(state.sigma[slot]), "games": int(state.win[slot] + state.lose[slot]),
+                    "created": record.timestamp, "updated": record.timestamp,
+                })
+            state.apply(record.players, record.teams, record.winner)
+            results = [
+                Result(player, team, float(state.mu[slot]), float(state.sigma[slot]),
+                       int(record.winner == team), int(record.winner not in (DRAW, team)))
+                for player, team, slot in zip(record.players, record.teams, slots)
+            ]
+            for result in results:
+                stats[result.id].apply(result, results, next_id, season, record.match_format)
+            next_id += 1
+        insert(db, User, list(new_users.values()))
+        insert(db, Match, matches)
+        insert(db, MatchPlayer, players)
+        imported += len(matches)
+        created += len(new_users)
+    for match_format, state in states.items():
+        write_scores(db, state, season, match_format)
+    for query in save_queries(stats, existing):
+        query.execute()
+    if isinstance(db, peewee.PostgresqlDatabase):
+        # ids were set explicitly, move the sequence past them
+        db.execute_sql("SELECT setval(pg_get_serial_sequence('match', 'id'), (SELECT MAX(id) FROM match))")
+    return imported, created
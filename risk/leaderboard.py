@@ -0,0 +1,87 @@
+import numpy as np
+
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from risk.model.match import Result
+from risk.model.rating import RatingStore
+from risk.ratings import Ratings
+
+
+PAGE = 10
+
+
+def conservative(mu: float, sigma: float) -> float:
+    return mu - 3 * sigma
+
+
+class Leaderboard:
+    # players of one (season, format) sorted by conservative rating, best first; rank
+    # lookups are a bisect, an update moves a single entry
+
+    def __init__(self):
+        self.keys: List[Tuple[float, str]] = []
+        self.entries: Dict[str, Tuple[float, str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @classmethod
+    def from_store(cls, store: RatingStore) -> 'Leaderboard':
+        # players with a rated game, sorted in one go
+        board = cls()
+        active = np.nonzero(store.games > 0)[0]
+        ratings = (-store.conservative()[active]).tolist()
+        board.keys = sorted(zip(ratings, (store.ids[slot] for slot in active.tolist())))
+        board.entries = {key[1]: key for key in board.keys}
+        return board
+
+    def update(self, player_id, mu: float, sigma: float):
+        player_id = str(player_id)
+        key = self.entries.get(player_id)
+        if key is not None:
+            del self.keys[bisect_left(self.keys, key)]
+        key = self.entries[player_id] = (-conservative(mu, sigma), player_id)
+        insort(self.keys, key)
+
+    def rank(self, player_id) -> Optional[int]:
+        key = self.entries.get(str(player_id))
+        if key is None:
+            return None
+        return bisect_left(self.keys, key) + 1
+
+    def page(self, page: int, size: int=PAGE) -> List[Tuple[int, str, float]]:
+        start = (page - 1) * size
+        return [(start + n + 1, player, -rating) for n, (rating, player) in enumerate(self.keys[start:start + size])]
+
+    @property
+    def pages(self) -> int:
+        return max(-(-len(self.keys) // PAGE), 1)
+
+
+class Leaderboards:
+
+    def __init__(self, ratings: Ratings):
+        self.ratings = ratings
+        self.boards: Dict[Tuple[int, str], Leaderboard] = {}
+
+    async def get(self, season, match_format) -> Leaderboard:
+        key = int(season), str(match_format)
+        board = self.boards.get(key)
+        if board is None:
+            store = await self.ratings.get(*key)
+            board = self.boards.setdefault(key, Leaderboard.from_store(store))
+        return board
+
+    def update(self, season, match_format, results: Iterable[Result]):
+        # boards that were never read get loaded with the new ratings on first use
+        board = self.boards.get((int(season), str(match_format)))
+        if board is not None:
+            for result in results:
+                if result.id in board.entries or result.win or result.lose:
+                    board.update(result.id, result.mu, result.sigma)
+
+    def invalidate(self, season=None, match_format=None):
+        for key in list(self.boards):
+            if season in (None, key[0]) and match_format in (None, key[1]):
+                del self.boards[key]
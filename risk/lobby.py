@@ -0,0 +1,109 @@
+import asyncio
+
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from risk.cache import ModelCache
+from risk.model.database import *
+from risk.manager import Manager
+from risk.writer import WriteBehind
+
+
+LobbyKey = Tuple[Optional[str], Optional[str]]
+
+
+def lobby_key(guild, channel) -> LobbyKey:
+    return (str(guild.id) if guild else None), (str(channel.id) if channel else None)
+
+
+class LobbyState:
+
+    def __init__(self, lobby: MatchLobby, match_format: MatchFormat, players=()):
+        self.lobby = lobby
+        self.match_format = match_format
+        self.players: Dict[str, MatchLobbyPlayer] = OrderedDict((str(p.player_id), p) for p in players)
+
+    def __contains__(self, user_id) -> bool:
+        return str(user_id) in self.players
+
+    def __len__(self) -> int:
+        return len(self.players)
+
+    @property
+    def key(self) -> LobbyKey:
+        return self.lobby.guild, self.lobby.channel
+
+    @property
+    def full(self) -> bool:
+        return len(self.players) >= self.match_format.max_player
+
+
+class LobbyManager:
+    # active lobbies live in memory keyed by (guild, channel), each key has its own lock
+    # so commands on one lobby queue up behind each other while other lobbies carry on,
+    # rows are written behind by the WriteBehind queue
+
+    def __init__(self, database: Manager, writer: WriteBehind):
+        self.database = database
+        self.writer = writer
+        self.active: Dict[LobbyKey, LobbyState] = {}
+        self.locks: Dict[LobbyKey, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.loaded = False
+
+    async def load(self, cache: ModelCache):
+        if self.loaded:
+            return
+        self.loaded = True
+        lobbies = await self.database.execute(MatchLobby.select().where(is_null(MatchLobby.closed)))
+        for lobby in lobbies:
+            match_format = await cache.get(MatchFormat, lobby.format_id)
+            state = LobbyState(lobby, match_format)
+            if lobby.channel is None or state.key in self.active:
+                # created before lobbies were scoped to a channel, or a second one for it
+                self.close(state)
+                continue
+            players = await self.database.execute(MatchLobbyPlayer.select().where(MatchLobbyPlayer.lobby == lobby))
+            state.players.update((str(p.player_id), p) for p in players)
+            self.active[state.key] = state
+
+    def get(self, key: LobbyKey) -> Optional[LobbyState]:
+        return self.active.get(key)
+
+    def find(self, user_id) -> Optional[LobbyState]:
+        return next((state for state in self.active.values() if user_id in state), None)
+
+    def lock(self, key: LobbyKey) -> asyncio.Lock:
+        return self.locks[key]
+
+    def create(self, key: LobbyKey, user: User, match_format: MatchFormat, score: Score) -> LobbyState:
+        guild, channel = key
+        lobby = MatchLobby(creator=user, format=match_format, guild=guild, channel=channel)
+        state = self.active[key] = LobbyState(lobby, match_format)
+        self.writer.insert(state.lobby)
+        self.join(state, user, score)
+        return state
+
+    def join(self, state: LobbyState, user: User, score: Score) -> MatchLobbyPlayer:
+        player = MatchLobbyPlayer(
+            lobby=state.lobby, player=user, mu=score.mu, sigma=score.sigma, games=score.games
+        )
+        state.players[str(user.id)] = player
+        state.lobby.updated = datetime.utcnow()
+        self.writer.insert(player)
+        self.writer.update(state.lobby, 'updated')
+        return player
+
+    def leave(self, state: LobbyState, user_id) -> MatchLobbyPlayer:
+        player = state.players.pop(str(user_id))
+        state.lobby.updated = datetime.utcnow()
+        self.writer.delete(player)
+        self.writer.update(state.lobby, 'updated')
+        return player
+
+    def close(self, state: LobbyState):
+        state.lobby.closed = datetime.utcnow()
+        state.lobby.updated = datetime.utcnow()
+        if self.active.get(state.key) is state:
+            del self.active[state.key]
+        self.writer.update(state.lobby, 'closed', 'updated')
@@ -0,0 +1,29 @@
+import peewee
+import peewee_async
+import time
+
+from risk.metrics import metrics
+from risk.profiling import profiler
+
+
+# async patch
+class Manager(peewee_async.Manager):
+
+    async def execute(self, query):
+        # get, create, update and delete all end up here
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = await super().execute(query)
+            failed = False
+            return result
+        finally:
+            seconds = time.perf_counter() - start
+            metrics.query(type(query).__name__, seconds, failed)
+            profiler.query(query, seconds)
+
+    async def get_or_none(self, source_, *args, **kwargs):
+        try:
+            return await self.get(source_, *args, **kwargs)
+        except peewee.DoesNotExist:
+            pass
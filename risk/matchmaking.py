@@ -0,0 +1,128 @@
+import time
+
+from bisect import bisect_left, insort
+from collections import deque
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from risk.model.database import *
+
+
+class QueueEntry(NamedTuple):
+    score: MatchLobbyPlayer
+    channel: object
+    joined: float
+
+    @property
+    def key(self) -> Tuple[float, float, str]:
+        return self.score.mu, self.score.sigma, str(self.score.player_id)
+
+
+class MatchQueue:
+    # waiting players ordered by (mu, sigma), a match is any run of `max_player`
+    # neighbours whose mu spread is within what the longest waiting of them allows
+
+    def __init__(self, match_format: MatchFormat, spread: float, widen: float, max_spread: float):
+        self.match_format = match_format
+        self.spread = spread
+        self.widen = widen
+        self.max_spread = max_spread
+        self.keys: List[Tuple[float, float, str]] = []
+        self.entries: Dict[str, QueueEntry] = {}
+
+    def __contains__(self, player_id) -> bool:
+        return str(player_id) in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def allowed(self, joined: float, now: float) -> float:
+        return min(self.spread + self.widen * (now - joined), self.max_spread)
+
+    def add(self, entry: QueueEntry):
+        self.entries[str(entry.score.player_id)] = entry
+        insort(self.keys, entry.key)
+
+    def remove(self, player_id) -> QueueEntry:
+        entry = self.entries.pop(str(player_id))
+        del self.keys[bisect_left(self.keys, entry.key)]
+        return entry
+
+    def window(self, now: float) -> Optional[int]:
+        # start of the acceptable window holding the longest waiting player, ties go to
+        # the tighter window; the oldest join per window comes from a monotonic deque
+        size = self.match_format.max_player
+        if len(self.keys) < size:
+            return None
+        joined = [self.entries[key[2]].joined for key in self.keys]
+        oldest = deque()
+        best = None
+        for end in range(len(self.keys)):
+            while oldest and joined[oldest[-1]] >= joined[end]:
+                oldest.pop()
+            oldest.append(end)
+            start = end - size + 1
+            if start < 0:
+                continue
+            if oldest[0] < start:
+                oldest.popleft()
+            spread = self.keys[end][0] - self.keys[start][0]
+            if spread <= self.allowed(joined[oldest[0]], now):
+                rank = (joined[oldest[0]], spread)
+                if best is None or rank < best[0]:
+                    best = (rank, start)
+        return best and best[1]
+
+    def pop(self, now: float=None) -> List[List[QueueEntry]]:
+        now = time.monotonic() if now is None else now
+        groups = []
+        start = self.window(now)
+        while start is not None:
+            keys = self.keys[start:start + self.match_format.max_player]
+            groups.append(sorted((self.remove(key[2]) for key in keys), key=lambda e: e.joined))
+            start = self.window(now)
+        return groups
+
+
+class Matchmaker:
+
+    def __init__(self, interval: float=5, spread: float=3, widen: float=0.05, max_spread: float=25):
+        self.interval = interval
+        self.spread = spread
+        self.widen = widen
+        self.max_spread = max_spread
+        self.queues: Dict[str, MatchQueue] = {}
+        self.players: Dict[str, str] = {}
+
+    def queue(self, player_id) -> Optional[MatchQueue]:
+        match_format = self.players.get(str(player_id))
+        return self.queues[match_format] if match_format else None
+
+    def add(self, match_format: MatchFormat, score: MatchLobbyPlayer, channel) -> MatchQueue:
+        return self.put(match_format, QueueEntry(score, channel, time.monotonic()))
+
+    def put(self, match_format: MatchFormat, entry: QueueEntry) -> MatchQueue:
+        # also puts popped entries back with the time they first joined, unless the
+        # player queued again meanwhile
+        queue = self.queues.get(match_format.id)
+        if queue is None:
+            queue = self.queues[match_format.id] = MatchQueue(match_format, self.spread, self.widen, self.max_spread)
+        if str(entry.score.player_id) not in self.players:
+            queue.add(entry)
+            self.players[str(entry.score.player_id)] = match_format.id
+        return queue
+
+    def remove(self, player_id) -> Optional[QueueEntry]:
+        queue = self.queue(player_id)
+        if queue is None:
+            return None
+        del self.players[str(player_id)]
+        return queue.remove(player_id)
+
+    def pop(self, now: float=None) -> List[Tuple[MatchFormat, List[QueueEntry]]]:
+        groups = []
+        for queue in self.queues.values():
+            for group in queue.pop(now):
+                for entry in group:
+                    del self.players[str(entry.score.player_id)]
+                groups.append((queue.match_format, group))
+        return groups
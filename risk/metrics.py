@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import os
+import time
+
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List
+
+
+log = logging.getLogger(__name__)
+
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERIES = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+# per task query counter, set a fresh [0] before running a command to count its queries
+query_count: ContextVar = ContextVar('query_count', default=None)
+
+
+def count_query():
+    counter = query_count.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+class Histogram:
+    # cumulative buckets the way prometheus expects them, quantiles are interpolated
+    # inside the bucket they fall in
+
+    def __init__(self, buckets=SECONDS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def lines(self, name: str, labels: str="") -> List[str]:
+        prefix = f"{labels}," if labels else ""
+        result, total = [], 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append(f'{name}_bucket{{{prefix}le="{bound}"}} {total}')
+        result.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        result.append(f"{name}_sum{suffix} {self.sum}")
+        result.append(f"{name}_count{suffix} {self.count}")
+        return result
+
+
+class Metrics:
+    # latency and query count of every command, latency of every query by kind, errors
+    # and how late the event loop wakes up; rendered in the prometheus text format
+
+    def __init__(self):
+        self.commands: Dict[str, Histogram] = defaultdict(Histogram)
+        self.command_queries: Dict[str, Histogram] = defaultdict(lambda: Histogram(QUERIES))
+        self.queries: Dict[str, Histogram] = defaultdict(Histogram)
+        self.errors = Counter()
+        self.lag = Histogram()
+        self.started = time.time()
+
+    @contextmanager
+    def command(self, name: str):
+        parent, counter = query_count.get(), [0]
+        token = query_count.set(counter)
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.errors[name] += 1
+            raise
+        finally:
+            self.commands[name].observe(time.perf_counter() - start)
+            self.command_queries[name].observe(counter[0])
+            query_count.reset(token)
+            # a command run from inside another one (`!spoof`) counts for both
+            if parent is not None:
+                parent[0] += counter[0]
+
+    def query(self, kind: str, seconds: float, failed: bool=False):
+        count_query()
+        self.queries[kind].observe(seconds)
+        if failed:
+            self.errors[f"query:{kind}"] += 1
+
+    async def watch_loop(self, interval: float=0.5):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.lag.observe(max(0.0, loop.time() - start - interval))
+
+    def render(self, cache=None) -> str:
+        lines = [
+            "# HELP risk_command_seconds Time spent in a command handler",
+            "# TYPE risk_command_seconds histogram",
+        ]
+        for name, histogram in sorted(self.commands.items()):
+            lines += histogram.lines("risk_command_seconds", f'command="{name}"')
+        lines += [
+            "# HELP risk_command_queries Database queries run by a command",
+            "# TYPE risk_command_queries histogram",
+        ]
+        for name, histogram in sorted(self.command_queries.items()):
+            lines += histogram.lines("risk_command_queries", f'command="{name}"')
+        lines += [
+            "# HELP risk_query_seconds Database query latency",
+            "# TYPE risk_query_seconds histogram",
+        ]
+        for kind, histogram in sorted(self.queries.items()):
+            lines += histogram.lines("risk_query_seconds", f'kind="{kind}"')
+        lines += [
+            "# HELP risk_errors_total Commands and queries that raised",
+            "# TYPE risk_errors_total counter",
+        ]
+        lines += [f'risk_errors_total{{source="{name}"}} {count}' for name, count in sorted(self.errors.items())]
+        lines += [
+            "# HELP risk_loop_lag_seconds How late the event loop ran a timer",
+            "# TYPE risk_loop_lag_seconds histogram",
+        ]
+        lines += self.lag.lines("risk_loop_lag_seconds")
+        if cache is not None:
+            lines += [
+                "# HELP risk_cache_requests_total Model cache lookups",
+                "# TYPE risk_cache_requests_total counter",
+            ]
+            for name, counts in sorted(cache.stats().items()):
+                lines += [
+                    f'risk_cache_requests_total{{model="{name}",result="hit"}} {counts["hits"]}',
+                    f'risk_cache_requests_total{{model="{name}",result="miss"}} {counts["misses"]}',
+                ]
+        lines += [
+            "# HELP risk_start_time_seconds When the process started",
+            "# TYPE risk_start_time_seconds gauge",
+            f"risk_start_time_seconds {self.started}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        lines = [f"{'command':<10} {'count':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'queries':>7} {'errors':>6}"]
+        for name, histogram in sorted(self.commands.items(), key=lambda item: -item[1].sum):
+            lines.append(
+                f"{name:<10} {histogram.count:>6} {histogram.quantile(0.5) * 1000:>6.1f}ms "
+                f"{histogram.quantile(0.95) * 1000:>6.1f}ms {histogram.quantile(0.99) * 1000:>6.1f}ms "
+                f"{self.command_queries[name].mean:>7.1f} {self.errors[name]:>6}"
+            )
+        queries = sum(histogram.count for histogram in self.queries.values())
+        seconds = sum(histogram.sum for histogram in self.queries.values())
+        lines.append(f"{queries} queries, {seconds:.2f}s in database")
+        lines.append(f"loop lag p99 {self.lag.quantile(0.99) * 1000:.1f}ms, max {self.lag.max * 1000:.1f}ms")
+        return "\n".join(lines)
+
+    async def serve(self, port: int, host: str="127.0.0.1", cache=None):
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+                body = self.render(cache).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/plain; version=0.0.4\r\n"
+                    + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                    + body
+                )
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+    async def write(self, path: str, interval: float=15, cache=None):
+        # replaced atomically so a textfile collector never reads half a file
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                with open(f"{path}.tmp", "w") as fp:
+                    fp.write(self.render(cache))
+                os.replace(f"{path}.tmp", path)
+            except OSError:
+                log.exception("writing metrics failed")
+
+
+metrics = Metrics()
@@ -0,0 +1,206 @@
+import numpy as np
+import random
+import time
+import trueskill
+
+from itertools import combinations, groupby
+from math import comb, factorial
+from typing import List, Sequence, Tuple
+
+
+CHUNK = 1 << 15
+# above this many distinct splits `search` stops enumerating and falls back to
+# snake draft seeding followed by local swaps
+LIMIT = 50000
+
+
+def team_sizes(players: int, team_size: int) -> List[int]:
+    teams = max(-(-players // max(team_size, 1)), 1)
+    return [team_size] * (teams - 1) + [players - team_size * (teams - 1)]
+
+
+def _runs(sizes):
+    # teams of the same size are interchangeable, keep the team numbers of each run
+    order = sorted(range(len(sizes)), key=lambda n: (-sizes[n], n))
+    return [(size, [n for n in order if sizes[n] == size]) for size, _ in groupby(sizes[n] for n in order)]
+
+
+def count_splits(sizes: Sequence[int]) -> int:
+    total, left = 1, sum(sizes)
+    for size, teams in _runs(sizes):
+        for _ in teams:
+            total *= comb(left, size)
+            left -= size
+        total //= factorial(len(teams))
+    return total
+
+
+def _groups(players, size, count):
+    if not count:
+        yield ()
+        return
+    head, tail = players[0], players[1:]
+    for rest in combinations(tail, size - 1):
+        left = tuple(p for p in tail if p not in rest)
+        for others in _groups(left, size, count - 1):
+            yield ((head,) + rest,) + others
+
+
+def _partitions(players, runs):
+    if not runs:
+        yield ()
+        return
+    (size, teams), runs = runs[0], runs[1:]
+    for chosen in (combinations(players, size * len(teams)) if runs else [players]):
+        left = tuple(p for p in players if p not in chosen)
+        for groups in _groups(chosen, size, len(teams)):
+            for others in _partitions(left, runs):
+                yield groups + others
+
+
+def canonical_splits(sizes: Sequence[int]) -> np.ndarray:
+    # every split exactly once as team numbers per player, a team of a given size
+    # always has `sizes[team]` players and same sized teams are ordered by their
+    # lowest player
+    runs = _runs(sizes)
+    teams = [team for _, run in runs for team in run]
+    splits = np.empty((count_splits(sizes), sum(sizes)), dtype=np.int8)
+    for n, groups in enumerate(_partitions(tuple(range(sum(sizes))), runs)):
+        for team, members in zip(teams, groups):
+            splits[n, list(members)] = team
+    return splits
+
+
+def ratings(players) -> Tuple[np.ndarray, np.ndarray]:
+    mu = np.fromiter((p.mu for p in players), dtype=np.float64, count=len(players))
+    sigma = np.fromiter((p.sigma for p in players), dtype=np.float64, count=len(players))
+    return mu, sigma
+
+
+def quality(mu: np.ndarray, sigma: np.ndarray, splits: np.ndarray, teams: int,
+            env: trueskill.TrueSkill=None) -> np.ndarray:
+    # trueskill.quality for every split at once, worked out from per team sums
+    # instead of the player level matrices. With more than two teams they are
+    # compared in order of their expected finish so the result doesn't depend on
+    # team numbering.
+    env = env or trueskill.global_env()
+    splits = np.atleast_2d(splits)
+    result = np.empty(len(splits), dtype=np.float64)
+    for start in range(0, len(splits), CHUNK):
+        result[start:start+CHUNK] = _quality(mu, sigma * sigma, splits[start:start+CHUNK], teams, env.beta ** 2)
+    return result
+
+
+def _quality(mu, variance, splits, teams, beta2):
+    onehot = splits[:, :, None] == np.arange(teams)
+    counts = onehot.sum(axis=1, dtype=np.float64)
+    means = np.einsum('snk,n->sk', onehot, mu)
+    variances = np.einsum('snk,n->sk', onehot, variance)
+    if teams > 2:
+        order = np.argsort(-means, axis=1, kind='stable')
+        counts, means, variances = (np.take_along_axis(v, order, axis=1) for v in (counts, means, variances))
+
+    ata = _rotated(beta2 * counts)
+    middle = ata + _rotated(variances)
+    diff = (means[:, :-1] - means[:, 1:])[:, :, None]
+
+    e_arg = -0.5 * (diff * np.linalg.solve(middle, diff)).sum(axis=(1, 2))
+    s_arg = np.linalg.det(ata) / np.linalg.det(middle)
+    return np.exp(e_arg) * np.sqrt(s_arg)
+
+
+def _rotated(values):
+    # A^T D A for the team comparison matrix A, with D a per team diagonal
+    size = values.shape[1] - 1
+    matrix = np.zeros((len(values), size, size), dtype=np.float64)
+    index = np.arange(size)
+    matrix[:, index, index] = values[:, :-1] + values[:, 1:]
+    matrix[:, index[:-1], index[1:]] = -values[:, 1:-1]
+    matrix[:, index[1:], index[:-1]] = -values[:, 1:-1]
+    return matrix
+
+
+def best(qualities: np.ndarray) -> np.ndarray:
+    return np.flatnonzero(np.isclose(qualities, qualities.max(), rtol=1e-12, atol=0))
+
+
+def seed(mu: np.ndarray, sigma: np.ndarray) -> np.ndarray:
+    # strongest first by conservative rating
+    return np.lexsort((-mu, -(mu - 3 * sigma)))
+
+
+def snake(mu: np.ndarray, sigma: np.ndarray, sizes: Sequence[int]) -> np.ndarray:
+    split = np.empty(len(mu), dtype=np.int8)
+    left = list(sizes)
+    forward = list(range(len(sizes)))
+    picks = []
+    while len(picks) < len(mu):
+        picks.extend(team for team in forward if left[team])
+        for team in forward:
+            left[team] = max(left[team] - 1, 0)
+        forward.reverse()
+    split[seed(mu, sigma)] = picks[:len(mu)]
+    return split
+
+
+def swaps(split: np.ndarray) -> np.ndarray:
+    first, second = np.triu_indices(len(split), k=1)
+    keep = split[first] != split[second]
+    first, second = first[keep], second[keep]
+    candidates = np.repeat(split[None, :], len(first), axis=0)
+    rows = np.arange(len(first))
+    candidates[rows, first] = split[second]
+    candidates[rows, second] = split[first]
+    return candidates
+
+
+def local_search(mu: np.ndarray, sigma: np.ndarray, split: np.ndarray, teams: int,
+                 nodes: int=None, deadline: float=None, env: trueskill.TrueSkill=None) -> Tuple[np.ndarray, float, int]:
+    # steepest ascent over single player swaps between teams
+    current = quality(mu, sigma, split, teams, env)[0]
+    visited = 1
+    while (nodes is None or visited < nodes) and (deadline is None or time.monotonic() < deadline):
+        candidates = swaps(split)
+        if nodes is not None:
+            candidates = candidates[:nodes - visited]
+        if not len(candidates):
+            break
+        results = quality(mu, sigma, candidates, teams, env)
+        visited += len(candidates)
+        n = int(results.argmax())
+        if results[n] <= current * (1 + 1e-12):
+            break
+        split, current = candidates[n], results[n]
+    return split, current, visited
+
+
+def search(mu: np.ndarray, sigma: np.ndarray, sizes: Sequence[int], limit: int=LIMIT, nodes: int=None,
+           timeout: float=None, env: trueskill.TrueSkill=None, rng: random.Random=None) -> np.ndarray:
+    # best split of the players into teams of `sizes`, exhaustive while the number
+    # of splits stays under `limit` and otherwise snake draft seeding plus local
+    # swaps, perturbed and repeated while the node or time budget allows
+    rng = rng or random
+    teams = len(sizes)
+    if count_splits(sizes) <= limit:
+        splits = canonical_splits(sizes)
+        return splits[rng.choice(best(quality(mu, sigma, splits, teams, env)))]
+
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    result, current, visited = local_search(mu, sigma, snake(mu, sigma, sizes), teams, nodes, deadline, env)
+    if nodes is None and deadline is None:
+        return result
+    split = result
+    while (nodes is None or visited < nodes) and (deadline is None or time.monotonic() < deadline):
+        split = split.copy()
+        for _ in range(teams):
+            first, second = rng.sample(range(len(split)), 2)
+            split[first], split[second] = split[second], split[first]
+        split, score, used = local_search(
+            mu, sigma, split, teams, None if nodes is None else nodes - visited, deadline, env
+        )
+        visited += used
+        if score > current:
+            result, current = split, score
+        else:
+            split = result
+    return result
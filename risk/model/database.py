@@ -1,11 +1,14 @@
 from peewee import *
+from peewee import Expression, OP
 
 import datetime
 
 
 __all__ = [
-    "Setting", "User", "Score",
+    "Setting", "User", "Score", "PlayerStats",
     "MatchPlayer", "MatchLobbyPlayer", "MatchLobby", "MatchFormat", "Match",
+    "MatchArchive", "MatchPlayerArchive", "MatchLobbyArchive", "MatchLobbyPlayerArchive",
+    "is_null",
 ]
 
 
@@ -13,6 +16,11 @@ MU = 25
 SIGMA = 25/3
 
 
+def is_null(field):
+    # `IS NULL` written out, a bound NULL parameter can't be matched to a partial index
+    return Expression(field, OP.IS, SQL("NULL"))
+
+
 class User(Model):
     id = CharField(primary_key=True)
     name = CharField()
@@ -42,6 +50,8 @@ class MatchFormat(Model):
 class MatchLobby(Model):
     creator = ForeignKeyField(User)
     format = ForeignKeyField(MatchFormat)
+    guild = CharField(null=True)
+    channel = CharField(null=True)
     closed = DateTimeField(null=True)
     created = DateTimeField(default=datetime.datetime.utcnow)
     updated = DateTimeField(default=datetime.datetime.utcnow)
@@ -93,3 +103,34 @@ class Score(Model):
     @property
     def games(self):
         return self.win + self.lose
+
+
+class PlayerStats(Model):
+    player = ForeignKeyField(User, primary_key=True)
+    data = TextField(default="{}")
+    updated = DateTimeField(default=datetime.datetime.utcnow)
+
+
+# closed lobbies and the matches of past seasons are moved to these by `risk season`,
+# same columns and ids as the live tables they come from
+
+class MatchLobbyArchive(MatchLobby):
+    pass
+
+
+class MatchLobbyPlayerArchive(MatchLobbyPlayer):
+    lobby = ForeignKeyField(MatchLobbyArchive)
+
+
+class MatchArchive(Match):
+    pass
+
+
+class MatchPlayerArchive(MatchPlayer):
+    match = ForeignKeyField(MatchArchive)
+
+
+MODELS = [
+    User, Setting, Match, MatchFormat, MatchLobby, MatchLobbyPlayer, MatchPlayer, Score, PlayerStats,
+    MatchArchive, MatchPlayerArchive, MatchLobbyArchive, MatchLobbyPlayerArchive,
+]
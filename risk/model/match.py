@@ -1,12 +1,17 @@
 import trueskill
 
-from itertools import combinations
+from datetime import datetime
+from peewee import Case
 from typing import List, NamedTuple
-from random import randint
 
+from risk.model import balance
 from risk.model.database import *
 
 
+NO_WINNER = -1
+DRAW = -2
+
+
 class Player(NamedTuple):
     id: str
     mu: float
@@ -27,52 +32,110 @@ class Team(NamedTuple):
 
 class MatchCreator:
 
-    def __init__(self, scores: List[MatchLobbyPlayer], match_format: MatchFormat):
+    def __init__(self, scores: List[MatchLobbyPlayer], match_format: MatchFormat, ratings=None):
+        # `ratings` is the RatingStore of the season and format, it has the players' current
+        # ratings where the lobby rows have them as they were when the player joined
         self.match_format = match_format
-        self.players: List[Player] = [Player(p.player_id, p.mu, p.sigma, p.games) for p in scores]
+        if ratings is None:
+            self.players: List[Player] = [Player(p.player_id, p.mu, p.sigma, p.games) for p in scores]
+            self.mu, self.sigma = balance.ratings(self.players)
+        else:
+            ids = [p.player_id for p in scores]
+            self.players = ratings.players(ids)
+            self.mu, self.sigma = ratings.ratings(ids)
 
-    def team_formats(self):
-        players = range(len(self.players))
-        iterables = combinations(players, self.match_format.team_size)
-        groups = map(lambda team: sorted([list(team), list(set(players) - set(team))]), iterables)
-        team_formats = []
+    def key(self) -> tuple:
+        # everything the balanced teams depend on, for memoizing them while a lobby fills
+        return self.match_format.team_size, tuple(sorted((str(p.id), p.mu, p.sigma) for p in self.players))
 
-        for group in groups:
-            if group not in team_formats:
-                team_formats.append(list(group))
+    def sizes(self):
+        return balance.team_sizes(len(self.players), self.match_format.team_size)
 
-        yield from team_formats
+    def splits(self):
+        return balance.canonical_splits(self.sizes())
+
+    def team_formats(self):
+        teams = len(self.sizes())
+        for split in self.splits():
+            yield [[m for m, team in enumerate(split) if team == n] for n in range(teams)]
 
     def quality(self, team_format):
-        setup = []
+        split = [0] * len(self.players)
         for n, team in enumerate(team_format):
-            setup.append([])
             for m in team:
-                player = self.players[m]
-                setup[n].append(trueskill.Rating(mu=player.mu, sigma=player.sigma))
-
-        return trueskill.quality(setup)
-
-    def balance(self) -> List[Team]:
-        setup = []
-        if self.match_format.team_size != 1:
-            results = {team_format: self.quality(team_format) for team_format in self.team_formats()}
-            results = [(k, results[k]) for k in sorted(results, key=results.get, reverse=True)]
-            best_quality = results[0][1]
-            results = [(k, v) for k, v in results if v == best_quality]
-            result = results[randint(0, len(results)-1)][0]
-            for n, team in enumerate(result):
-                setup.append(Team(n, []))
-                for m in team:
-                    setup[n].players.append(self.players[m])
-        else:
-            for n in range(len(self.players)):
-                setup.append(Team(n, [self.players[n]]))
+                split[m] = n
+        return balance.quality(self.mu, self.sigma, split, len(team_format))[0]
+
+    def balance(self, nodes: int=None, timeout: float=None) -> List[Team]:
+        return balance_teams(self.players, self.match_format.team_size, nodes=nodes, timeout=timeout)
+
 
-        return setup
+def balance_teams(players: List[Player], team_size: int, limit: int=balance.LIMIT, nodes: int=None,
+                  timeout: float=None) -> List[Team]:
+    # module level so it can be shipped to a process pool
+    mu, sigma = balance.ratings(players)
+    if team_size == 1:
+        return [Team(n, [players[m]]) for n, m in enumerate(balance.seed(mu, sigma))]
+
+    sizes = balance.team_sizes(len(players), team_size)
+    result = balance.search(mu, sigma, sizes, limit=limit, nodes=nodes, timeout=timeout)
+    return [Team(n, [players[m] for m, team in enumerate(result) if team == n]) for n in range(len(sizes))]
+
+
+class Result(NamedTuple):
+    id: str
+    team: int
+    mu: float
+    sigma: float
+    win: int
+    lose: int
 
 
 class MatchCalculator:
-    def __init__(self, scores: List[MatchPlayer], winner):
-        self.match_format = match_format
-        self.players: List[Player] = [Player(p.player_id, p.mu, p.sigma, p.games) for p in scores]
+    # all ratings of a match come out of a single trueskill.rate call, the winning team
+    # ranks first and every other team shares second, a draw ranks everyone first
+
+    def __init__(self, scores: List[MatchPlayer], winner: int, env: trueskill.TrueSkill=None):
+        self.env = env or trueskill.global_env()
+        self.winner = winner
+        self.teams: List[Team] = []
+        for score in sorted(scores, key=lambda s: s.team):
+            if not self.teams or self.teams[-1].team != score.team:
+                self.teams.append(Team(score.team, []))
+            self.teams[-1].players.append(Player(score.player_id, score.mu, score.sigma, score.games))
+
+    @classmethod
+    def from_teams(cls, teams: List[Team], winner: int, env: trueskill.TrueSkill=None) -> 'MatchCalculator':
+        calculator = cls([], winner, env)
+        calculator.teams = teams
+        return calculator
+
+    def ranks(self) -> List[int]:
+        if self.winner == DRAW:
+            return [0] * len(self.teams)
+        return [0 if team.team == self.winner else 1 for team in self.teams]
+
+    def rate(self) -> List[Result]:
+        rating_groups = [
+            [self.env.create_rating(player.mu, player.sigma) for player in team.players] for team in self.teams
+        ]
+        ranks = self.ranks()
+        results = []
+        for team, rank, ratings in zip(self.teams, ranks, self.env.rate(rating_groups, ranks)):
+            won = int(self.winner != DRAW and rank == 0)
+            lost = int(self.winner != DRAW and rank != 0)
+            for player, rating in zip(team.players, ratings):
+                results.append(Result(player.id, team.team, rating.mu, rating.sigma, won, lost))
+        return results
+
+
+def update_scores(results: List[Result], season: int, match_format: MatchFormat):
+    # a single UPDATE for every player of a match, values picked per player with CASE
+    players = [result.id for result in results]
+    return Score.update(
+        mu=Case(Score.player, [(result.id, result.mu) for result in results]),
+        sigma=Case(Score.player, [(result.id, result.sigma) for result in results]),
+        win=Score.win + Case(Score.player, [(result.id, result.win) for result in results]),
+        lose=Score.lose + Case(Score.player, [(result.id, result.lose) for result in results]),
+        updated=datetime.utcnow(),
+    ).where(Score.player.in_(players) & (Score.season == season) & (Score.format == match_format))
@@ -0,0 +1,159 @@
+import numpy as np
+import trueskill
+
+from typing import Iterable, List, NamedTuple, Sequence, Tuple
+
+from risk.model.match import DRAW, Team
+from risk.model.rating import RatingState
+
+
+CHUNK = 4096
+# Gauss-Hermite nodes for the integral behind the odds of more than two teams
+NODES, WEIGHTS = np.polynomial.hermite.hermgauss(48)
+EPSILON = 1e-15
+
+
+def cdf(x: np.ndarray) -> np.ndarray:
+    # the erfc approximation trueskill itself uses, over whole arrays
+    z = np.abs(x) / np.sqrt(2)
+    t = 1 / (1 + z / 2)
+    r = t * np.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 + t * (
+        -0.18628806 + t * (0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (-0.82215223 + t * 0.17087277)))
+    ))))))
+    return np.where(x > 0, 1 - r / 2, r / 2)
+
+
+def team_ratings(mu: np.ndarray, sigma: np.ndarray, matches: np.ndarray, teams: np.ndarray, count: int, width: int,
+                 env: trueskill.TrueSkill=None) -> Tuple[np.ndarray, np.ndarray]:
+    # per player arrays, `matches` numbering each player's match from 0 and `teams` its team
+    # in there from 0; gives the (count, width) mean and variance of every team's performance,
+    # a variance of 0 marks a team the match doesn't have
+    env = env or trueskill.global_env()
+    index = np.asarray(matches) * width + np.asarray(teams)
+    mean = np.bincount(index, weights=mu, minlength=count * width)
+    variance = np.bincount(index, weights=sigma ** 2 + env.tau ** 2 + env.beta ** 2, minlength=count * width)
+    return mean.reshape(count, width), variance.reshape(count, width)
+
+
+def win_probabilities(mean: np.ndarray, variance: np.ndarray) -> np.ndarray:
+    # the chance of every team performing best, for every match at once. Draws are left
+    # out, the odds of a match add up to 1.
+    present = variance > 0
+    if mean.shape[1] == 2 and present.all():
+        first = cdf((mean[:, 0] - mean[:, 1]) / np.sqrt(variance.sum(axis=1)))
+        return np.stack([first, 1 - first], axis=1)
+    result = np.empty(mean.shape, dtype=np.float64)
+    for start in range(0, len(mean), CHUNK):
+        chunk = slice(start, start + CHUNK)
+        result[chunk] = _win_probabilities(mean[chunk], variance[chunk], present[chunk])
+    return result
+
+
+def _win_probabilities(mean, variance, present):
+    # team i performs best with the chance E[prod over j != i of cdf((x - mean_j) / std_j)],
+    # x being its performance, the expectation taken at the quadrature nodes
+    std = np.sqrt(np.where(present, variance, 1))
+    x = mean[:, :, None] + np.sqrt(2) * std[:, :, None] * NODES
+    beaten = cdf((x[:, :, None, :] - mean[:, None, :, None]) / std[:, None, :, None])
+    others = present[:, None, :, None] & ~np.eye(mean.shape[1], dtype=bool)[None, :, :, None]
+    odds = (np.where(others, beaten, 1.0).prod(axis=2) * WEIGHTS).sum(axis=2) / np.sqrt(np.pi)
+    odds = np.where(present, odds, 0.0)
+    return odds / odds.sum(axis=1, keepdims=True)
+
+
+def predict(teams: List[Team], env: trueskill.TrueSkill=None) -> List[float]:
+    # odds of the teams of one match, in the order given
+    mu = np.fromiter((p.mu for team in teams for p in team.players), dtype=np.float64)
+    sigma = np.fromiter((p.sigma for team in teams for p in team.players), dtype=np.float64)
+    numbers = np.fromiter((n for n, team in enumerate(teams) for _ in team.players), dtype=np.intp)
+    mean, variance = team_ratings(mu, sigma, np.zeros(len(numbers), dtype=np.intp), numbers, 1, len(teams), env)
+    return win_probabilities(mean, variance)[0].tolist()
+
+
+class Calibration(NamedTuple):
+    matches: int
+    skipped: int
+    brier: float
+    log_loss: float
+    # what a model that is right about its odds scores on the same matches, mean and std
+    expected_brier: Tuple[float, float]
+    expected_log_loss: Tuple[float, float]
+    # (mean predicted, observed, count) per bin of predicted odds
+    bins: List[Tuple[float, float, int]]
+
+
+def replay(matches: Iterable[Tuple[int, int, Sequence[str], Sequence[int]]], env: trueskill.TrueSkill=None,
+           state: RatingState=None) -> Tuple[np.ndarray, np.ndarray, int]:
+    # rates (match, winner, players, teams) in order like recompute does, starting from
+    # `state`, and keeps the ratings every match was played with; gives the odds of every
+    # match that has a winner, the index of that winner in its row and how many matches
+    # were draws
+    state = RatingState(env=env) if state is None else state
+    mu, sigma, match_numbers, team_numbers, winners = [], [], [], [], []
+    width = skipped = 0
+    for _, winner, players, teams in matches:
+        slots = np.fromiter((state.slot(p) for p in players), dtype=np.intp, count=len(players))
+        numbers, inverse = np.unique(teams, return_inverse=True)
+        if winner != DRAW and winner in numbers:
+            mu.append(state.mu[slots])
+            sigma.append(state.sigma[slots])
+            match_numbers.append(np.full(len(slots), len(winners), dtype=np.intp))
+            team_numbers.append(inverse)
+            winners.append(int(np.searchsorted(numbers, winner)))
+            width = max(width, len(numbers))
+        else:
+            skipped += 1
+        state.apply(players, teams, winner)
+    if not winners:
+        return np.empty((0, 0)), np.empty(0, dtype=np.intp), skipped
+    mean, variance = team_ratings(
+        np.concatenate(mu), np.concatenate(sigma), np.concatenate(match_numbers), np.concatenate(team_numbers),
+        len(winners), width, state.env
+    )
+    return win_probabilities(mean, variance), np.array(winners, dtype=np.intp), skipped
+
+
+def scores(odds: np.ndarray, winners: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Brier score summed over the teams of a match (for two teams twice the one sided
+    # score) and log loss, per match
+    won = np.take_along_axis(odds, winners[:, None], axis=1)[:, 0]
+    return (odds ** 2).sum(axis=1) - 2 * won + 1, -np.log(np.maximum(won, EPSILON))
+
+
+def simulate(odds: np.ndarray, samples: int=200, rng: np.random.Generator=None) -> np.ndarray:
+    # (samples, 2) Brier score and log loss of seasons whose winners are drawn from the
+    # predicted odds themselves
+    rng = rng or np.random.default_rng()
+    bounds = np.cumsum(odds, axis=1)[:, :-1]
+    result = np.empty((samples, 2), dtype=np.float64)
+    for sample in range(samples):
+        winners = (rng.random(len(odds))[:, None] >= bounds).sum(axis=1)
+        brier, log_loss = scores(odds, winners)
+        result[sample] = brier.mean(), log_loss.mean()
+    return result
+
+
+def calibration(odds: np.ndarray, winners: np.ndarray, skipped: int=0, samples: int=200, bins: int=10,
+                rng: np.random.Generator=None) -> Calibration:
+    if not len(odds):
+        return Calibration(0, skipped, float("nan"), float("nan"), (float("nan"),) * 2, (float("nan"),) * 2, [])
+    brier, log_loss = scores(odds, winners)
+    simulated = simulate(odds, samples, rng)
+    present = odds > 0
+    predicted = odds[present]
+    observed = (np.arange(odds.shape[1]) == winners[:, None])[present]
+    number = np.minimum((predicted * bins).astype(np.intp), bins - 1)
+    counts = np.bincount(number, minlength=bins)
+    table = [
+        (float(p), float(o), int(n)) for p, o, n in zip(
+            np.bincount(number, weights=predicted, minlength=bins) / np.maximum(counts, 1),
+            np.bincount(number, weights=observed, minlength=bins) / np.maximum(counts, 1),
+            counts,
+        ) if n
+    ]
+    return Calibration(
+        len(odds), skipped, float(brier.mean()), float(log_loss.mean()),
+        (float(simulated[:, 0].mean()), float(simulated[:, 0].std())),
+        (float(simulated[:, 1].mean()), float(simulated[:, 1].std())),
+        table,
+    )
@@ -0,0 +1,128 @@
+import math
+import numpy as np
+import trueskill
+
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from risk.model.match import DRAW, MatchCalculator, Player, Result, Team
+
+
+class RatingState:
+    # ratings of every player seen so far in flat arrays, `slots` maps player id to index
+
+    def __init__(self, capacity: int=1024, env: trueskill.TrueSkill=None):
+        self.env = env or trueskill.global_env()
+        self.slots: Dict[str, int] = {}
+        self.ids: List[str] = []
+        self.mu = np.full(capacity, self.env.mu, dtype=np.float64)
+        self.sigma = np.full(capacity, self.env.sigma, dtype=np.float64)
+        self.win = np.zeros(capacity, dtype=np.int32)
+        self.lose = np.zeros(capacity, dtype=np.int32)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def slot(self, player_id) -> int:
+        player_id = str(player_id)
+        slot = self.slots.get(player_id)
+        if slot is None:
+            slot = self.slots[player_id] = len(self.ids)
+            self.ids.append(player_id)
+            if slot == len(self.mu):
+                self.grow()
+        return slot
+
+    def grow(self):
+        size = len(self.mu)
+        self.mu = np.concatenate([self.mu, np.full(size, self.env.mu)])
+        self.sigma = np.concatenate([self.sigma, np.full(size, self.env.sigma)])
+        self.win = np.concatenate([self.win, np.zeros(size, dtype=np.int32)])
+        self.lose = np.concatenate([self.lose, np.zeros(size, dtype=np.int32)])
+
+    def apply(self, players: Sequence[str], teams: Sequence[int], winner: int):
+        slots = np.fromiter((self.slot(p) for p in players), dtype=np.intp, count=len(players))
+        teams = np.asarray(teams)
+        numbers = np.unique(teams)
+        if len(numbers) == 2:
+            self.rate_two(slots, teams == numbers[0], numbers[0], numbers[1], winner)
+        else:
+            self.rate_many(slots, teams, winner)
+        if winner != DRAW:
+            won = teams == winner
+            self.win[slots[won]] += 1
+            self.lose[slots[~won]] += 1
+
+    def rate_two(self, slots: np.ndarray, first: np.ndarray, a: int, b: int, winner: int):
+        # closed form of trueskill.rate for two teams, the factor graph needs no iteration here
+        env = self.env
+        mu = self.mu[slots]
+        variance = self.sigma[slots] ** 2 + env.tau ** 2
+        c = math.sqrt(variance.sum() + len(slots) * env.beta ** 2)
+        draw_margin = trueskill.calc_draw_margin(env.draw_probability, len(slots), env) / c
+        sign = np.where(first, 1.0, -1.0)
+        if winner == b:
+            sign = -sign
+        diff = float((sign * mu).sum()) / c
+        if winner == DRAW:
+            v, w = env.v_draw(diff, draw_margin), env.w_draw(diff, draw_margin)
+        else:
+            v, w = env.v_win(diff, draw_margin), env.w_win(diff, draw_margin)
+        self.mu[slots] = mu + sign * variance / c * v
+        self.sigma[slots] = np.sqrt(variance * (1 - variance / c ** 2 * w))
+
+    def rate_many(self, slots: np.ndarray, teams: np.ndarray, winner: int):
+        players = [Player(self.ids[s], self.mu[s], self.sigma[s], 0) for s in slots]
+        groups = {}
+        for player, team in zip(players, teams.tolist()):
+            groups.setdefault(team, Team(team, [])).players.append(player)
+        calculator = MatchCalculator.from_teams([groups[team] for team in sorted(groups)], winner, self.env)
+        for result in calculator.rate():
+            slot = self.slots[result.id]
+            self.mu[slot] = result.mu
+            self.sigma[slot] = result.sigma
+
+
+class RatingStore(RatingState):
+    # the live ratings of one (season, format), loaded from Score once and updated with
+    # every rated match; everything that needs ratings reads these arrays
+
+    @classmethod
+    def from_scores(cls, rows: Iterable[Tuple[str, float, float, int, int]],
+                    env: trueskill.TrueSkill=None) -> 'RatingStore':
+        # rows of (player, mu, sigma, win, lose)
+        store = cls(env=env)
+        for player, mu, sigma, win, lose in rows:
+            slot = store.slot(player)
+            store.mu[slot], store.sigma[slot], store.win[slot], store.lose[slot] = mu, sigma, win, lose
+        return store
+
+    def lookup(self, players: Sequence) -> np.ndarray:
+        return np.fromiter((self.slot(p) for p in players), dtype=np.intp, count=len(players))
+
+    def ratings(self, players: Sequence) -> Tuple[np.ndarray, np.ndarray]:
+        slots = self.lookup(players)
+        return self.mu[slots], self.sigma[slots]
+
+    def players(self, players: Sequence) -> List[Player]:
+        slots = self.lookup(players)
+        games = self.win[slots] + self.lose[slots]
+        return [
+            Player(self.ids[slot], mu, sigma, played)
+            for slot, mu, sigma, played in zip(slots, self.mu[slots].tolist(), self.sigma[slots].tolist(),
+                                               games.tolist())
+        ]
+
+    @property
+    def games(self) -> np.ndarray:
+        return self.win[:len(self)] + self.lose[:len(self)]
+
+    def conservative(self) -> np.ndarray:
+        return self.mu[:len(self)] - 3 * self.sigma[:len(self)]
+
+    def update(self, results: Iterable[Result]):
+        for result in results:
+            slot = self.slot(result.id)
+            self.mu[slot] = result.mu
+            self.sigma[slot] = result.sigma
+            self.win[slot] += result.win
+            self.lose[slot] += result.lose
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import time
+
+from collections import defaultdict
+from itertools import count
+from typing import Dict, Hashable, List, Tuple
+
+import discord
+
+
+log = logging.getLogger(__name__)
+
+LIMIT = 2000
+
+
+class Bucket:
+    # token bucket mirroring discord's per channel limit, so we wait here instead of
+    # being answered with a 429
+
+    def __init__(self, rate: int=5, per: float=5.0):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.last = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate / self.per)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+
+
+class Status:
+
+    def __init__(self, channel: discord.abc.Messageable):
+        self.channel = channel
+        self.message: discord.Message = None
+        self.content: str = None
+        self.shown: str = None
+        self.final = False
+        self.queued: int = None
+
+
+class Outbox:
+    # everything the bot says goes out per channel at most once every `interval` seconds
+    # and through the channel's bucket: notices queued in between are joined into one
+    # message, every lobby or match being created keeps a single status message that is
+    # edited to its latest content. Notices and statuses go out in the order they were queued.
+
+    def __init__(self, interval: float=1.0, rate: int=5, per: float=5.0):
+        self.interval = interval
+        self.rate = rate
+        self.per = per
+        self.order = count()
+        self.notices: Dict[int, List[Tuple[int, str]]] = defaultdict(list)
+        self.statuses: Dict[Hashable, Status] = {}
+        self.channels: Dict[int, discord.abc.Messageable] = {}
+        self.buckets: Dict[int, Bucket] = {}
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.sent: Dict[int, float] = {}
+
+    def notice(self, channel: discord.abc.Messageable, content: str):
+        self.notices[channel.id].append((next(self.order), content))
+        self.schedule(channel)
+
+    def status(self, key: Hashable, channel: discord.abc.Messageable, content: str, final: bool=False):
+        # `final` is the last content of the status, after it is shown the key is forgotten
+        status = self.statuses.get(key)
+        if status is None:
+            status = self.statuses[key] = Status(channel)
+        status.content = content
+        status.final = final
+        if status.queued is None:
+            status.queued = next(self.order)
+        self.schedule(status.channel)
+
+    def schedule(self, channel: discord.abc.Messageable):
+        self.channels[channel.id] = channel
+        if channel.id not in self.tasks:
+            self.tasks[channel.id] = asyncio.ensure_future(self.run(channel.id))
+
+    async def run(self, channel_id: int):
+        try:
+            while self.notices.get(channel_id) or self.pending(channel_id):
+                wait = self.sent.get(channel_id, 0) + self.interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self.sent[channel_id] = time.monotonic()
+                await self.flush(channel_id)
+        finally:
+            del self.tasks[channel_id]
+
+    def pending(self, channel_id: int) -> List[Hashable]:
+        return [
+            key for key, status in self.statuses.items()
+            if status.channel.id == channel_id and status.content != status.shown
+        ]
+
+    async def flush(self, channel_id: int):
+        channel = self.channels[channel_id]
+        bucket = self.buckets.setdefault(channel_id, Bucket(self.rate, self.per))
+        items = [(n, content, None) for n, content in self.notices.pop(channel_id, [])]
+        items += [(self.statuses[key].queued, None, key) for key in self.pending(channel_id)]
+        # runs of notices between statuses are joined
+        run = []
+        for _, notice, key in sorted(items, key=lambda item: item[0]):
+            if key is None:
+                run.append(notice)
+                continue
+            await self.send_notices(channel, bucket, run)
+            run = []
+            await self.send_status(channel, bucket, key)
+        await self.send_notices(channel, bucket, run)
+
+    async def send_notices(self, channel: discord.abc.Messageable, bucket: Bucket, notices: List[str]):
+        for content in self.group(notices):
+            await bucket.acquire()
+            try:
+                await channel.send(content)
+            except discord.HTTPException:
+                log.exception("sending to channel %s failed", channel.id)
+
+    async def send_status(self, channel: discord.abc.Messageable, bucket: Bucket, key: Hashable):
+        status = self.statuses[key]
+        content = status.content
+        await bucket.acquire()
+        try:
+            if status.message:
+                await status.message.edit(content=content)
+            else:
+                status.message = await channel.send(content)
+        except discord.HTTPException:
+            # given up on, the next change tries again
+            log.exception("updating the status in channel %s failed", channel.id)
+        status.shown = content
+        if status.content == content:
+            status.queued = None
+            if status.final:
+                del self.statuses[key]
+
+    @staticmethod
+    def group(notices: List[str]) -> List[str]:
+        messages = []
+        for notice in notices:
+            if messages and len(messages[-1]) + len(notice) + 1 <= LIMIT:
+                messages[-1] += f"\n{notice}"
+            else:
+                messages.append(notice)
+        return messages
+
+    async def drain(self):
+        # wait for everything queued so far to go out
+        while self.tasks:
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
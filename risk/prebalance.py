@@ -0,0 +1,81 @@
+import asyncio
+import logging
+
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from risk.lobby import LobbyKey, LobbyState
+from risk.model.database import *
+from risk.model.match import MatchCreator, Team
+from risk.model.rating import RatingStore
+
+
+log = logging.getLogger(__name__)
+
+Balance = Callable[[List[MatchLobbyPlayer], MatchFormat, RatingStore], Awaitable[List[Team]]]
+
+
+class Prebalancer:
+    # balances a lobby in the background every time its roster changes, once it has
+    # enough players to start, so `!start` finds the teams already made. Results are
+    # kept by roster (players and their ratings), work for a roster a lobby no longer
+    # has is cancelled.
+
+    def __init__(self, balance: Balance, size: int=64):
+        self.balance = balance
+        self.size = size
+        self.results: Dict[Tuple, List[Team]] = OrderedDict()
+        self.pending: Dict[LobbyKey, Tuple[Tuple, asyncio.Task]] = {}
+
+    def remember(self, key: Tuple, teams: List[Team]):
+        self.results[key] = teams
+        self.results.move_to_end(key)
+        while len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+    def cancel(self, lobby: LobbyKey):
+        _, task = self.pending.pop(lobby, (None, None))
+        if task and not task.done():
+            task.cancel()
+
+    def update(self, state: LobbyState, ratings: RatingStore=None):
+        lobby, scores = state.key, list(state.players.values())
+        if len(scores) < state.match_format.min_player:
+            self.cancel(lobby)
+            return
+        key = MatchCreator(scores, state.match_format, ratings).key()
+        if key in self.results:
+            self.cancel(lobby)
+            return
+        if lobby in self.pending and self.pending[lobby][0] == key:
+            return
+        self.cancel(lobby)
+        task = asyncio.ensure_future(self.run(key, scores, state.match_format, ratings))
+        task.add_done_callback(self.done)
+        self.pending[lobby] = key, task
+
+    @staticmethod
+    def done(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            log.error("background balancing failed", exc_info=task.exception())
+
+    async def run(self, key: Tuple, scores: List[MatchLobbyPlayer], match_format: MatchFormat,
+                  ratings: RatingStore=None) -> List[Team]:
+        teams = await self.balance(scores, match_format, ratings)
+        self.remember(key, teams)
+        return teams
+
+    async def get(self, scores: List[MatchLobbyPlayer], match_format: MatchFormat,
+                  ratings: RatingStore=None) -> List[Team]:
+        key = MatchCreator(scores, match_format, ratings).key()
+        if key in self.results:
+            return self.results[key]
+        for lobby, (pending, task) in list(self.pending.items()):
+            if pending == key:
+                del self.pending[lobby]
+                try:
+                    return await task
+                except Exception:
+                    # already logged, balance again below
+                    pass
+        return await self.run(key, scores, match_format, ratings)
@@ -0,0 +1,235 @@
+import asyncio
+import cProfile
+import glob
+import io
+import json
+import logging
+import logging.handlers
+import os
+import pstats
+import random
+import time
+import tracemalloc
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import List
+
+
+log = logging.getLogger(__name__)
+
+COMMANDS, QUERIES, MEMORY = "commands", "queries", "memory"
+SLOW_QUERIES = "slow_queries.log"
+
+# the command a query runs for, so slow queries can be traced back to one
+current_command: ContextVar = ContextVar('current_command', default=None)
+
+
+class Profiler:
+    # everything is off until switched on by config or `!profile`: sampled profiles of
+    # command handlers, a log of queries slower than `slow_query` seconds and periodic
+    # tracemalloc snapshots, all written below `directory` and rotated there
+
+    def __init__(self, directory: str="profile", sample: float=0.1, slow_query: float=0.1, engine: str="cprofile",
+                 memory_interval: float=600, backups: int=50, max_bytes: int=10 * 1024 * 1024):
+        self.enabled = set()
+        self.task: asyncio.Task = None
+        self.active = False
+        self.slow_log: logging.Logger = None
+        self.configure(directory, sample, slow_query, engine, memory_interval, backups, max_bytes)
+
+    def configure(self, directory: str="profile", sample: float=0.1, slow_query: float=0.1, engine: str="cprofile",
+                  memory_interval: float=600, backups: int=50, max_bytes: int=10 * 1024 * 1024):
+        self.directory = directory
+        self.sample = sample
+        self.slow_query = slow_query
+        self.engine = engine
+        self.memory_interval = memory_interval
+        self.backups = backups
+        self.max_bytes = max_bytes
+
+    def path(self, kind: str, name: str) -> str:
+        directory = os.path.join(self.directory, kind)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, name)
+
+    def rotate(self, kind: str, pattern: str):
+        files = sorted(glob.glob(self.path(kind, pattern)), key=os.path.getmtime)
+        for name in files[:-self.backups]:
+            os.remove(name)
+
+    @staticmethod
+    def stamp() -> str:
+        return datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+
+    def enable(self, kind: str):
+        if kind not in (COMMANDS, QUERIES, MEMORY):
+            raise Exception(f"unknown profile `{kind}`, use {COMMANDS}, {QUERIES} or {MEMORY}")
+        if kind in self.enabled:
+            return
+        self.enabled.add(kind)
+        if kind == QUERIES:
+            self.slow_log = logging.getLogger(f"{__name__}.slow_queries")
+            self.slow_log.propagate = False
+            self.slow_log.handlers = [logging.handlers.RotatingFileHandler(
+                self.path(QUERIES, SLOW_QUERIES), maxBytes=self.max_bytes, backupCount=self.backups
+            )]
+            self.slow_log.setLevel(logging.INFO)
+        elif kind == MEMORY:
+            tracemalloc.start(25)
+            self.task = asyncio.ensure_future(self.watch_memory())
+
+    def disable(self, kind: str):
+        if kind not in self.enabled:
+            return
+        self.enabled.discard(kind)
+        if kind == QUERIES:
+            for handler in self.slow_log.handlers:
+                handler.close()
+            self.slow_log.handlers = []
+        elif kind == MEMORY:
+            self.task.cancel()
+            self.task = None
+            tracemalloc.stop()
+
+    @contextmanager
+    def command(self, name: str):
+        token = current_command.set(name)
+        # one sample at a time, profilers see every coroutine the loop runs meanwhile
+        sampled = COMMANDS in self.enabled and not self.active and random.random() < self.sample
+        try:
+            if not sampled:
+                yield
+                return
+            self.active = True
+            start = time.perf_counter()
+            stop = self.start_profile()
+            try:
+                yield
+            finally:
+                self.active = False
+                path = self.path(COMMANDS, f"{name}-{self.stamp()}-{(time.perf_counter() - start) * 1000:.0f}ms.prof")
+                stop(path)
+                self.rotate(COMMANDS, "*.prof")
+        finally:
+            current_command.reset(token)
+
+    def start_profile(self):
+        if self.engine == "yappi":
+            try:
+                import yappi
+            except ImportError:
+                log.warning("yappi is not installed, profiling with cProfile")
+                self.engine = "cprofile"
+            else:
+                yappi.set_clock_type("wall")
+                yappi.start()
+
+                def stop(path: str):
+                    yappi.stop()
+                    yappi.get_func_stats().save(path, type="pstat")
+                    yappi.clear_stats()
+
+                return stop
+        profile = cProfile.Profile()
+        profile.enable()
+
+        def stop(path: str):
+            profile.disable()
+            profile.dump_stats(path)
+
+        return stop
+
+    def query(self, query, seconds: float):
+        # `query` is a peewee query, or a description for writes that have none at hand
+        if QUERIES in self.enabled and seconds >= self.slow_query:
+            sql, params = query.sql() if hasattr(query, "sql") else (str(query), ())
+            self.slow_log.info(json.dumps({
+                "time": datetime.utcnow().isoformat(), "ms": round(seconds * 1000, 3), "command": current_command.get(),
+                "sql": sql, "params": [str(param) for param in params or ()],
+            }))
+
+    def snapshot(self) -> str:
+        if not tracemalloc.is_tracing():
+            raise Exception("memory profiling is off, use `!profile on memory`")
+        path = self.path(MEMORY, f"snapshot-{self.stamp()}.tracemalloc")
+        tracemalloc.take_snapshot().dump(path)
+        self.rotate(MEMORY, "*.tracemalloc")
+        return path
+
+    async def watch_memory(self):
+        while True:
+            await asyncio.sleep(self.memory_interval)
+            try:
+                self.snapshot()
+            except Exception:
+                log.exception("memory snapshot failed")
+
+    def status(self) -> List[str]:
+        return [
+            f"{COMMANDS:<8} {'on' if COMMANDS in self.enabled else 'off'}, {self.sample:.0%} sampled with {self.engine}",
+            f"{QUERIES:<8} {'on' if QUERIES in self.enabled else 'off'}, slower than {self.slow_query * 1000:.0f}ms",
+            f"{MEMORY:<8} {'on' if MEMORY in self.enabled else 'off'}, every {self.memory_interval:.0f}s",
+            f"files in {os.path.abspath(self.directory)}",
+        ]
+
+
+def report_commands(directory: str, top: int) -> List[str]:
+    files = sorted(glob.glob(os.path.join(directory, COMMANDS, "*.prof")))
+    if not files:
+        return ["no command profiles"]
+    durations = defaultdict(list)
+    for name in files:
+        command, _, duration = os.path.basename(name)[:-len(".prof")].rsplit("-", 2)
+        durations[command].append(float(duration[:-len("ms")]))
+    lines = [f"{'command':<12} {'samples':>7} {'mean':>8} {'max':>8}"]
+    for command, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+        lines.append(f"{command:<12} {len(values):>7} {sum(values) / len(values):>6.0f}ms {max(values):>6.0f}ms")
+    stream = io.StringIO()
+    pstats.Stats(*files, stream=stream).strip_dirs().sort_stats("cumulative").print_stats(top)
+    return lines + [""] + stream.getvalue().strip().splitlines()
+
+
+def report_queries(directory: str, top: int) -> List[str]:
+    queries = defaultdict(list)
+    commands = defaultdict(Counter)
+    for name in glob.glob(os.path.join(directory, QUERIES, f"{SLOW_QUERIES}*")):
+        with open(name) as fp:
+            for line in fp:
+                entry = json.loads(line)
+                queries[entry["sql"]].append(entry["ms"])
+                commands[entry["sql"]][entry["command"] or "-"] += 1
+    if not queries:
+        return ["no slow queries"]
+    lines = [f"{'count':>6} {'total':>10} {'max':>9}  commands / sql"]
+    for sql, values in sorted(queries.items(), key=lambda item: -sum(item[1]))[:top]:
+        called = ", ".join(f"{command} {count}" for command, count in commands[sql].most_common(3))
+        lines.append(f"{len(values):>6} {sum(values):>8.0f}ms {max(values):>7.0f}ms  {called}")
+        lines.append(f"{'':>27}{sql[:200]}")
+    return lines
+
+
+def report_memory(directory: str, top: int) -> List[str]:
+    files = sorted(glob.glob(os.path.join(directory, MEMORY, "*.tracemalloc")))
+    if not files:
+        return ["no memory snapshots"]
+    last = tracemalloc.Snapshot.load(files[-1])
+    if len(files) == 1:
+        return [f"{os.path.basename(files[-1])}"] + [str(stat) for stat in last.statistics("lineno")[:top]]
+    first = tracemalloc.Snapshot.load(files[0])
+    lines = [f"growth from {os.path.basename(files[0])} to {os.path.basename(files[-1])}"]
+    return lines + [str(stat) for stat in last.compare_to(first, "lineno")[:top]]
+
+
+def report(directory: str="profile", top: int=20) -> str:
+    sections = [
+        ("Commands", report_commands(directory, top)),
+        ("Slow queries", report_queries(directory, top)),
+        ("Memory", report_memory(directory, top)),
+    ]
+    return "\n\n".join(f"{title}\n" + "\n".join(lines) for title, lines in sections)
+
+
+profiler = Profiler()
@@ -0,0 +1,52 @@
+from typing import Dict, Iterable, Tuple
+
+from risk.model.database import *
+from risk.model.match import Result
+from risk.model.rating import RatingStore
+from risk.manager import Manager
+
+
+class Ratings:
+    # one RatingStore per (season, format), read from Score with a single query the first
+    # time it's needed and kept up to date by close_match from then on
+
+    def __init__(self, database: Manager):
+        self.database = database
+        self.stores: Dict[Tuple[int, str], RatingStore] = {}
+
+    async def load(self, season):
+        # the whole season up front, so the first command of a format doesn't wait for it
+        rows = await self.database.execute(
+            Score.select(Score.format, Score.player, Score.mu, Score.sigma, Score.win, Score.lose)
+                 .where(Score.season == int(season))
+                 .order_by(Score.format)
+                 .tuples()
+        )
+        grouped: Dict[str, list] = {}
+        for match_format, *row in rows:
+            grouped.setdefault(match_format, []).append(row)
+        for match_format, format_rows in grouped.items():
+            self.stores.setdefault((int(season), str(match_format)), RatingStore.from_scores(format_rows))
+
+    async def get(self, season, match_format) -> RatingStore:
+        key = int(season), str(match_format)
+        store = self.stores.get(key)
+        if store is None:
+            rows = await self.database.execute(
+                Score.select(Score.player, Score.mu, Score.sigma, Score.win, Score.lose)
+                     .where((Score.season == key[0]) & (Score.format == key[1]))
+                     .tuples()
+            )
+            # another command may have loaded it while this one waited
+            store = self.stores.setdefault(key, RatingStore.from_scores(rows))
+        return store
+
+    def update(self, season, match_format, results: Iterable[Result]):
+        store = self.stores.get((int(season), str(match_format)))
+        if store is not None:
+            store.update(results)
+
+    def invalidate(self, season=None, match_format=None):
+        for key in list(self.stores):
+            if season in (None, key[0]) and match_format in (None, key[1]):
+                del self.stores[key]
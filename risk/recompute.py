@@ -0,0 +1,120 @@
+import peewee
+import trueskill
+
+from itertools import groupby
+from typing import Iterator, List, Tuple
+
+from risk.model.database import *
+from risk.model.database import MU, SIGMA
+from risk.model.match import DRAW, Result, update_scores
+from risk.model.rating import RatingState, RatingStore
+from risk.season import carried_from
+
+
+BATCH = 500
+# where the matches of a season are, archived ones first as `risk season` only moves
+# the older ones there
+HISTORY = [(MatchArchive, MatchPlayerArchive), (Match, MatchPlayer)]
+
+
+def rated(query, match=Match):
+    return query.where(match.closed.is_null(False) & ((match.winner >= 0) | (match.winner == DRAW)))
+
+
+def formats(season: int) -> List[str]:
+    names = set()
+    for match, _ in HISTORY:
+        query = rated(match.select(match.format).distinct().where(match.season == season), match)
+        names.update(row[0] for row in query.tuples())
+    return sorted(names)
+
+
+def stream(season: int, match_format: str, chunk: int=1000) -> Iterator[Tuple[int, int, List[str], List[int]]]:
+    for match, match_player in HISTORY:
+        yield from _stream(match, match_player, season, match_format, chunk)
+
+
+def _stream(match, match_player, season, match_format, chunk):
+    # (match, winner, players, teams) in match order, read in keyset pages so only
+    # one page of matches and their players is held at a time
+    scope = (match.season == season) & (match.format == match_format)
+    last = 0
+    while True:
+        matches = list(rated(
+            match.select(match.id, match.winner).where(scope & (match.id > last)), match
+        ).order_by(match.id).limit(chunk).tuples())
+        if not matches:
+            return
+        winners = dict(matches)
+        # scoped like the page itself, the id range also spans the matches of other formats
+        players = (
+            rated(match_player.select(match_player.match, match_player.player, match_player.team)
+                              .join(match)
+                              .where(scope & match_player.match.between(matches[0][0], matches[-1][0])), match)
+            .order_by(match_player.match, match_player.id)
+            .tuples()
+            .iterator()
+        )
+        for match_id, rows in groupby(players, key=lambda row: row[0]):
+            if match_id in winners:
+                rows = list(rows)
+                yield match_id, winners[match_id], [row[1] for row in rows], [row[2] for row in rows]
+        last = matches[-1][0]
+
+
+def baseline(season: int, match_format: str, env: trueskill.TrueSkill=None) -> RatingState:
+    # a season started by `risk season rollover` is replayed from the ratings carried into
+    # it, those players keep them in write_scores even without a match this season
+    source = carried_from(season)
+    if source is None:
+        return RatingState(env=env)
+    query = Score.select(Score.player, Score.mu, Score.sigma, peewee.Value(0), peewee.Value(0)).where(
+        (Score.season == source) & (Score.format == match_format)
+    )
+    return RatingStore.from_scores(query.tuples().iterator(), env)
+
+
+def replay(season: int, match_format: str, chunk: int=1000, state: RatingState=None) -> RatingState:
+    state = baseline(season, match_format) if state is None else state
+    for _, winner, players, teams in stream(season, match_format, chunk):
+        state.apply(players, teams, winner)
+    return state
+
+
+def results(state: RatingState) -> Iterator[Result]:
+    for slot, player in enumerate(state.ids):
+        yield Result(player, -1, float(state.mu[slot]), float(state.sigma[slot]),
+                     int(state.win[slot]), int(state.lose[slot]))
+
+
+def write_scores(db: peewee.Database, state: RatingState, season: int, match_format: str):
+    # resets the season's scores for the format, then sets every replayed player in
+    # batched CASE updates and inserts the ones without a Score row yet
+    scope = (Score.season == season) & (Score.format == match_format)
+    with db.atomic():
+        Score.update(mu=MU, sigma=SIGMA, win=0, lose=0).where(scope).execute()
+        existing = {row[0] for row in Score.select(Score.player).where(scope).tuples()}
+        batch = []
+        for result in results(state):
+            batch.append(result)
+            if len(batch) == BATCH:
+                update_scores(batch, season, match_format).execute()
+                batch = []
+        if batch:
+            update_scores(batch, season, match_format).execute()
+        missing = [
+            {"player": r.id, "season": season, "format": match_format,
+             "mu": r.mu, "sigma": r.sigma, "win": r.win, "lose": r.lose}
+            for r in results(state) if r.id not in existing
+        ]
+        for start in range(0, len(missing), BATCH):
+            Score.insert_many(missing[start:start + BATCH]).execute()
+
+
+def recompute(db: peewee.Database, season: int, match_format: str=None, chunk: int=1000) -> List[Tuple[str, int]]:
+    replayed = []
+    for name in ([match_format] if match_format else formats(season)):
+        state = replay(season, name, chunk)
+        write_scores(db, state, season, name)
+        replayed.append((name, len(state)))
+    return replayed
@@ -0,0 +1,122 @@
+import peewee
+
+from playhouse.migrate import SchemaMigrator, migrate as run_migrations
+from typing import Callable, Dict, List, Tuple
+
+from risk.model.database import *
+from risk.model.database import MODELS
+
+
+def indexes(db: peewee.Database) -> List[peewee.ModelIndex]:
+    # MySQL has no partial indexes, it gets plain ones on `closed` instead; the
+    # predicates are literal SQL since index definitions can't take parameters
+    partial = not isinstance(db, peewee.MySQLDatabase)
+    result = [
+        Score.index(Score.player, Score.season, Score.format, unique=True, name="score_player_season_format"),
+        MatchPlayer.index(MatchPlayer.player, MatchPlayer.match, name="matchplayer_player_match"),
+        Match.index(Match.season, Match.format, Match.id, name="match_season_format_id"),
+        MatchArchive.index(
+            MatchArchive.season, MatchArchive.format, MatchArchive.id, name="matcharchive_season_format_id"
+        ),
+    ]
+    if partial:
+        result += [
+            Match.index(Match.id, where=peewee.SQL("closed IS NULL"), name="match_open"),
+            MatchLobby.index(
+                MatchLobby.guild, MatchLobby.channel, unique=True, where=peewee.SQL("closed IS NULL"),
+                name="matchlobby_open"
+            ),
+        ]
+    else:
+        result += [
+            Match.index(Match.closed, name="match_open"),
+            MatchLobby.index(MatchLobby.closed, MatchLobby.guild, MatchLobby.channel, name="matchlobby_open"),
+        ]
+    return result
+
+
+def missing_columns(db: peewee.Database) -> List[Tuple[peewee.Model, peewee.Field]]:
+    missing = []
+    for model in MODELS:
+        columns = {column.name for column in db.get_columns(model._meta.table_name)}
+        missing += [(model, field) for field in model._meta.sorted_fields if field.column_name not in columns]
+    return missing
+
+
+def deduplicate_scores(db: peewee.Database) -> int:
+    # keep the newest row of every (player, season, format) so the unique index can be built
+    duplicates = (
+        Score.select(Score.player, Score.season, Score.format, peewee.fn.MAX(Score.id))
+             .group_by(Score.player, Score.season, Score.format)
+             .having(peewee.fn.COUNT(Score.id) > 1)
+             .tuples()
+    )
+    deleted = 0
+    for player, season, match_format, keep in list(duplicates):
+        deleted += Score.delete().where(
+            (Score.player == player) & (Score.season == season) & (Score.format == match_format) & (Score.id != keep)
+        ).execute()
+    return deleted
+
+
+def migrate(db: peewee.Database) -> List[str]:
+    applied = []
+    db.create_tables(MODELS)
+    migrator = SchemaMigrator.from_database(db)
+    for model, field in missing_columns(db):
+        if not field.null and field.default is None:
+            raise Exception(f"can't add required column `{model._meta.table_name}.{field.column_name}`")
+        run_migrations(migrator.add_column(model._meta.table_name, field.column_name, field))
+        applied.append(f"added column {model._meta.table_name}.{field.column_name}")
+    with db.atomic():
+        deleted = deduplicate_scores(db)
+    if deleted:
+        applied.append(f"removed {deleted} duplicate score rows")
+    for index in indexes(db):
+        table = index._model._meta.table_name
+        if index._name not in {existing.name for existing in db.get_indexes(table)}:
+            db.execute(index.safe(False))
+            applied.append(f"created index {index._name}")
+    return applied
+
+
+# queries every command path depends on, with representative parameters
+HOT_QUERIES: Dict[str, Callable[[], peewee.Query]] = {
+    "active lobby": lambda: MatchLobby.select().where(
+        (MatchLobby.guild == "0") & (MatchLobby.channel == "0") & is_null(MatchLobby.closed)
+    ),
+    "open lobbies": lambda: MatchLobby.select().where(is_null(MatchLobby.closed)),
+    "active match": lambda: Match.select().join(MatchPlayer).where(
+        (MatchPlayer.player == "0") & is_null(Match.closed)
+    ),
+    "match players": lambda: MatchPlayer.select().where(MatchPlayer.match == 0),
+    "score": lambda: Score.select().where((Score.player == "0") & (Score.season == 0) & (Score.format == "0")),
+    "player stats": lambda: PlayerStats.select().where(PlayerStats.player == "0"),
+    "season matches": lambda: Match.select(Match.id, Match.winner).where(
+        (Match.season == 0) & (Match.format == "0") & (Match.id > 0)
+    ).order_by(Match.id),
+}
+
+
+def full_scans(db: peewee.Database, query: peewee.Query) -> List[str]:
+    sql, params = query.sql()
+    if isinstance(db, peewee.PostgresqlDatabase):
+        # tiny tables are always cheapest to scan, only report scans the planner can't avoid
+        db.execute_sql("SET enable_seqscan = off")
+        try:
+            rows = db.execute_sql(f"EXPLAIN {sql}", params).fetchall()
+        finally:
+            db.execute_sql("SET enable_seqscan = on")
+        return [row[0].strip() for row in rows if "Seq Scan" in row[0]]
+    if isinstance(db, peewee.MySQLDatabase):
+        cursor = db.execute_sql(f"EXPLAIN {sql}", params)
+        columns = [column[0] for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return [f"ALL on {row['table']}" for row in rows if row["type"] == "ALL" and not row["possible_keys"]]
+    rows = db.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    return [row[-1] for row in rows if row[-1].startswith("SCAN") and "INDEX" not in row[-1]]
+
+
+def check(db: peewee.Database) -> Dict[str, List[str]]:
+    return {name: scans for name, scans in ((name, full_scans(db, query())) for name, query in HOT_QUERIES.items())
+            if scans}
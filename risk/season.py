@@ -0,0 +1,108 @@
+import datetime
+import peewee
+
+from typing import Iterator, List, Optional, Tuple
+
+from risk.model.database import *
+
+
+BATCH = 1000
+
+
+def current_season() -> int:
+    return int(Setting.get(Setting.key == 'match.season').value)
+
+
+def carried_key(season: int) -> str:
+    return f"match.season.{season}.carried_from"
+
+
+def carried_from(season: int) -> Optional[int]:
+    # the season whose ratings `season` started with, None if it started from scratch
+    setting = Setting.get_or_none(Setting.key == carried_key(season))
+    return int(setting.value) if setting else None
+
+
+def carry_scores(season: int, new_season: int) -> int:
+    # everyone starts the new season with the rating they ended the last one with,
+    # wins and losses counted afresh
+    now = datetime.datetime.utcnow()
+    query = Score.select(
+        Score.player, peewee.Value(new_season), Score.format, Score.mu, Score.sigma, peewee.Value(0),
+        peewee.Value(0), peewee.Value(now), peewee.Value(now)
+    ).where(Score.season == season)
+    fields = [Score.player, Score.season, Score.format, Score.mu, Score.sigma, Score.win, Score.lose, Score.created,
+              Score.updated]
+    Score.insert_from(query, fields).on_conflict_ignore().execute()
+    return Score.select().where(Score.season == new_season).count()
+
+
+def newest(model, child, key: peewee.Field) -> List[int]:
+    # SQLite and MySQL before 8.0 hand out ids counting on from the highest one in the
+    # table, the newest row of the table and the parent of the newest child stay live so
+    # ids never go back to ones the archive already has
+    rows = [
+        model.select(peewee.fn.MAX(model.id)).scalar(),
+        child.select(key).order_by(child.id.desc()).limit(1).scalar(),
+    ]
+    return [row for row in rows if row is not None]
+
+
+def copy(model, archive, condition: peewee.Expression):
+    fields = model._meta.sorted_fields
+    archive.insert_from(
+        model.select(*fields).where(condition), [archive._meta.fields[field.name] for field in fields]
+    ).execute()
+
+
+def archive(db: peewee.Database, model, archive_model, child, child_archive, key: peewee.Field,
+            scope: peewee.Expression, batch: int=BATCH) -> Iterator[Tuple[int, int]]:
+    # moves the rows of `model` in `scope` and the `child` rows pointing at them with
+    # `key`, `batch` parents per transaction; yields the parents and children moved
+    keep = newest(model, child, key)
+    if keep:
+        scope = scope & model.id.not_in(keep)
+    last = 0
+    while True:
+        ids = [
+            row[0] for row in
+            model.select(model.id).where(scope & (model.id > last)).order_by(model.id).limit(batch).tuples()
+        ]
+        if not ids:
+            return
+        with db.atomic():
+            copy(model, archive_model, model.id.in_(ids))
+            copy(child, child_archive, key.in_(ids))
+            children = child.delete().where(key.in_(ids)).execute()
+            model.delete().where(model.id.in_(ids)).execute()
+        yield len(ids), children
+        last = ids[-1]
+
+
+def archive_lobbies(db: peewee.Database, batch: int=BATCH) -> Iterator[Tuple[int, int]]:
+    scope = MatchLobby.closed.is_null(False)
+    return archive(
+        db, MatchLobby, MatchLobbyArchive, MatchLobbyPlayer, MatchLobbyPlayerArchive, MatchLobbyPlayer.lobby, scope,
+        batch
+    )
+
+
+def archive_matches(db: peewee.Database, season: int, batch: int=BATCH) -> Iterator[Tuple[int, int]]:
+    # closed matches of the seasons before `season`, the open ones stay until they are closed
+    scope = (Match.season < season) & Match.closed.is_null(False)
+    return archive(db, Match, MatchArchive, MatchPlayer, MatchPlayerArchive, MatchPlayer.match, scope, batch)
+
+
+def rollover(db: peewee.Database, season: int=None) -> Tuple[int, int, int]:
+    # the bot caches the season, it has to be restarted afterwards
+    current = current_season()
+    season = current + 1 if season is None else season
+    if season <= current:
+        raise Exception(f"season {season} must come after the current season {current}")
+    with db.atomic():
+        carried = carry_scores(current, season)
+        Setting.insert(key=carried_key(season), value=str(current)).execute()
+        Setting.update(value=str(season), updated=datetime.datetime.utcnow()).where(
+            Setting.key == 'match.season'
+        ).execute()
+    return current, season, carried
@@ -0,0 +1,161 @@
+import asyncio
+import peewee
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+
+from risk.metrics import metrics
+from risk.profiling import profiler
+
+
+PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "foreign_keys": 1,
+    "busy_timeout": 5000,
+    "cache_size": -16000,
+    "temp_store": "memory",
+    "mmap_size": 1 << 28,
+}
+
+
+def load_sqlite(path: str) -> peewee.SqliteDatabase:
+    return peewee.SqliteDatabase(path, pragmas=PRAGMAS)
+
+
+class SqliteManager:
+    # the Manager interface over SQLite: every thread gets its own connection, all writes
+    # and transactions go through one writer thread while reads spread over the reader
+    # threads, WAL lets them read the last commit while a write is going on. A
+    # transaction holds the write lock so no other command's write lands inside it.
+
+    def __init__(self, database: peewee.SqliteDatabase, readers: int=4):
+        self.database = database
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix="sqlite-writer")
+        # an in-memory database only exists on the connection that created it
+        in_memory = database.database == ":memory:"
+        self.readers = self.writer if in_memory or not readers else ThreadPoolExecutor(
+            readers, thread_name_prefix="sqlite-reader"
+        )
+        self.transaction: ContextVar = ContextVar(f"transaction_{id(self)}", default=False)
+        self.lock: asyncio.Lock = None
+
+    async def run(self, executor: ThreadPoolExecutor, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(executor, func, *args)
+
+    async def write(self, func, *args):
+        if self.transaction.get():
+            return await self.run(self.writer, func, *args)
+        self.lock = self.lock or asyncio.Lock()
+        async with self.lock:
+            return await self.run(self.writer, func, *args)
+
+    async def timed(self, kind: str, call, query):
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = await call
+            failed = False
+            return result
+        finally:
+            seconds = time.perf_counter() - start
+            metrics.query(kind, seconds, failed)
+            profiler.query(query, seconds)
+
+    @staticmethod
+    def fetch(query):
+        if isinstance(query, peewee.SelectBase):
+            return list(query.execute())
+        return query.execute()
+
+    async def execute(self, query):
+        if isinstance(query, peewee.SelectBase) and not self.transaction.get():
+            call = self.run(self.readers, self.fetch, query)
+        else:
+            call = self.write(self.fetch, query)
+        return await self.timed(type(query).__name__, call, query)
+
+    async def get(self, source_, *args, **kwargs):
+        if isinstance(source_, peewee.Query):
+            query, model = source_, source_.model
+        else:
+            query, model = source_.select(), source_
+        if args:
+            query = query.where(*args)
+        if kwargs:
+            query = query.filter(**kwargs)
+        for obj in await self.execute(query.limit(1)):
+            return obj
+        raise model.DoesNotExist
+
+    async def get_or_none(self, source_, *args, **kwargs):
+        try:
+            return await self.get(source_, *args, **kwargs)
+        except peewee.DoesNotExist:
+            pass
+
+    async def create(self, model_, **data):
+        instance = model_(**data)
+        pk = await self.execute(model_.insert(**dict(instance.__data__)))
+        if instance._pk is None:
+            instance._pk = pk
+        return instance
+
+    async def create_or_get(self, model_, **kwargs):
+        try:
+            async with self.atomic():
+                return (await self.create(model_, **kwargs)), True
+        except peewee.IntegrityError:
+            query = [getattr(model_, k) == v for k, v in kwargs.items() if getattr(model_, k).primary_key]
+            return (await self.get(model_, *query)), False
+
+    async def update(self, obj, only=None):
+        return await self.timed("ModelUpdate", self.write(obj.save, False, only), f"save {obj!r}")
+
+    async def delete(self, obj):
+        return await self.timed("ModelDelete", self.write(obj.delete_instance), f"delete {obj!r}")
+
+    def atomic(self) -> 'SqliteTransaction':
+        return SqliteTransaction(self)
+
+    def close(self):
+        for executor in {self.writer, self.readers}:
+            executor.shutdown()
+
+
+class SqliteTransaction:
+    # peewee keeps the transaction stack per thread, so entering and leaving on the
+    # writer thread nests blocks as savepoints like it does for synchronous code
+
+    def __init__(self, manager: SqliteManager):
+        self.manager = manager
+        self.context = None
+        self.token = None
+        self.locked = False
+
+    async def __aenter__(self):
+        manager = self.manager
+        if not manager.transaction.get():
+            manager.lock = manager.lock or asyncio.Lock()
+            await manager.lock.acquire()
+            self.locked = True
+        self.token = manager.transaction.set(True)
+        self.context = manager.database.atomic()
+        try:
+            return await manager.run(manager.writer, self.context.__enter__)
+        except BaseException:
+            self.release()
+            raise
+
+    async def __aexit__(self, *exc):
+        try:
+            return await self.manager.run(self.manager.writer, self.context.__exit__, *exc)
+        finally:
+            self.release()
+
+    def release(self):
+        self.manager.transaction.reset(self.token)
+        if self.locked:
+            self.manager.lock.release()
+            self.locked = False
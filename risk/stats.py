@@ -0,0 +1,99 @@
+import json
+
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterable, List, Set
+
+from peewee import Case
+
+from risk.model.database import *
+from risk.model.match import Result
+
+
+RECENT = 10
+TRAJECTORY = 50
+PEOPLE = 25
+# teammates and opponents are only cut back to the top PEOPLE once there are this many,
+# so someone played with a lot lately has the time to overtake the early ones
+PRUNE = 4 * PEOPLE
+# players per INSERT or UPDATE, the CASE of an UPDATE takes two variables a player and
+# SQLite allows 999 in a statement before 3.32
+BATCH = 300
+
+
+class Stats:
+    # everything !stats shows for one player, kept up to date as matches close and
+    # stored as a single json document per player
+
+    def __init__(self, data: Dict=None):
+        data = data or {}
+        self.win: int = data.get("win", 0)
+        self.lose: int = data.get("lose", 0)
+        self.draw: int = data.get("draw", 0)
+        self.formats: Dict[str, Dict[str, int]] = data.get("formats", {})
+        self.recent: str = data.get("recent", "")
+        self.teammates = Counter(data.get("teammates", {}))
+        self.opponents = Counter(data.get("opponents", {}))
+        self.ratings: List[List] = data.get("ratings", [])
+
+    @classmethod
+    def loads(cls, data: str) -> 'Stats':
+        return cls(json.loads(data))
+
+    def dumps(self) -> str:
+        return json.dumps({
+            "win": self.win, "lose": self.lose, "draw": self.draw, "formats": self.formats,
+            "recent": self.recent, "teammates": self.teammates, "opponents": self.opponents,
+            "ratings": self.ratings,
+        }, separators=(",", ":"))
+
+    @property
+    def games(self) -> int:
+        return self.win + self.lose + self.draw
+
+    def apply(self, player: Result, results: Iterable[Result], match_id: int, season: int, match_format: str):
+        outcome = "win" if player.win else "lose" if player.lose else "draw"
+        setattr(self, outcome, getattr(self, outcome) + 1)
+        counts = self.formats.setdefault(match_format, {"win": 0, "lose": 0, "draw": 0})
+        counts[outcome] += 1
+        self.recent = (self.recent + outcome[0].upper())[-RECENT:]
+        self.teammates.update([other.id for other in results if other.team == player.team and other.id != player.id])
+        self.opponents.update([other.id for other in results if other.team != player.team])
+        self.teammates, self.opponents = prune(self.teammates), prune(self.opponents)
+        self.ratings.append([match_id, season, match_format, round(player.mu, 3), round(player.sigma, 3)])
+        del self.ratings[:-TRAJECTORY]
+
+    def rating(self, season: int, match_format: str):
+        for _, rating_season, rating_format, mu, sigma in reversed(self.ratings):
+            if rating_season == season and rating_format == match_format:
+                return mu, sigma
+        return None
+
+
+def prune(counter: Counter) -> Counter:
+    return Counter(dict(counter.most_common(PEOPLE))) if len(counter) > PRUNE else counter
+
+
+def stats_queries(rows: Iterable[PlayerStats], results: List[Result], match_id: int, season: int,
+                  match_format: str) -> List:
+    existing = {row.player_id: Stats.loads(row.data) for row in rows}
+    stats = {}
+    for result in results:
+        stats[result.id] = existing.get(result.id) or Stats()
+        stats[result.id].apply(result, results, match_id, int(season), str(match_format))
+    return save_queries(stats, set(existing))
+
+
+def save_queries(stats: Dict[str, Stats], existing: Set[str]) -> List:
+    # one INSERT for players without a record and one UPDATE for the rest, per BATCH players
+    created = [(player, data.dumps()) for player, data in stats.items() if player not in existing]
+    updated = [(player, data.dumps()) for player, data in stats.items() if player in existing]
+    queries = []
+    for start in range(0, len(created), BATCH):
+        queries.append(PlayerStats.insert_many([{"player": p, "data": d} for p, d in created[start:start + BATCH]]))
+    for start in range(0, len(updated), BATCH):
+        page = updated[start:start + BATCH]
+        queries.append(PlayerStats.update(
+            data=Case(PlayerStats.player, page), updated=datetime.utcnow()
+        ).where(PlayerStats.player.in_([p for p, _ in page])))
+    return queries
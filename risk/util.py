@@ -1,59 +1,73 @@
 import peewee
-import peewee_async
-
-from ruamel.yaml import YAML
 
 from risk.model.database import *
+from risk.model.database import MODELS, MU, SIGMA
+
+
+# peewee_async, the SQLite adapter and ruamel.yaml are imported by the loaders that use
+# them, so commands that never touch them don't pay for the import
 
 
 def load_config(file):
+    from ruamel.yaml import YAML
+
     with open(file) as fp:
         yaml = YAML()
         return yaml.load(fp)
 
 
+def load_trueskill(config):
+    # beta, tau and draw_probability under `trueskill`, `risk calibrate` helps picking them
+    import trueskill
+
+    return trueskill.setup(mu=MU, sigma=SIGMA, **(config.get('trueskill') or {}))
+
+
 def load_db(config):
 
+    if config['database']['driver'] == 'SQLite':
+        from risk.sqlite import load_sqlite
+
+        db = load_sqlite(config['database']['schema'])
+        db.bind(MODELS)
+        return db
     if config['database']['driver'] == 'MySQL':
         driver = peewee.MySQLDatabase
     elif config['database']['driver'] == 'Postgresql':
         driver = peewee.PostgresqlDatabase
     else:
-        raise Exception("Requires `MySQL` or `Postgresql` as driver")
+        raise Exception("Requires `MySQL`, `Postgresql` or `SQLite` as driver")
     db = driver(
         config['database']['schema'],
         user=config['database']['user'],
         password=config['database']['password'],
         host=config['database']['host']
     )
-    db.bind([User, Setting, Match, MatchFormat, MatchLobby, MatchLobbyPlayer, MatchPlayer, Score])
+    db.bind(MODELS)
     return db
 
 
 def load_async_db(config):
+    import peewee_async
+    from risk.manager import Manager
+
+    if config['database']['driver'] == 'SQLite':
+        from risk.sqlite import SqliteManager
+
+        return SqliteManager(load_db(config), readers=config['database'].get('readers', 4))
     if config['database']['driver'] == 'MySQL':
         driver = peewee_async.PooledMySQLDatabase
     elif config['database']['driver'] == 'Postgresql':
         driver = peewee_async.PooledPostgresqlDatabase
     else:
-        raise Exception("Requires `MySQL` or `Postgresql` as driver")
+        raise Exception("Requires `MySQL`, `Postgresql` or `SQLite` as driver")
     db = driver(
         config['database']['schema'],
         user=config['database']['user'],
         password=config['database']['password'],
         host=config['database']['host']
     )
-    db.bind([User, Setting, Match, MatchFormat, MatchLobby, MatchLobbyPlayer, MatchPlayer, Score])
+    db.bind(MODELS)
     database = Manager(db)
     db.set_allow_sync(False)
     return database
-
-
-# async patch
-class Manager(peewee_async.Manager):
-
-    async def get_or_none(self, source_, *args, **kwargs):
-        try:
-            return await self.get(source_, *args, **kwargs)
-        except peewee.DoesNotExist:
-            pass
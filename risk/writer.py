@@ -0,0 +1,187 @@
+import asyncio
+import logging
+
+from typing import Dict, List
+
+from risk.manager import Manager
+
+
+log = logging.getLogger(__name__)
+
+INSERT, INSERT_MANY, UPDATE, DELETE = "insert", "insert_many", "update", "delete"
+BATCH = 500
+RETRIES = 5
+
+
+class WriteBehind:
+    # commands queue their writes here and return, a background task applies them in
+    # order, in one transaction, once `size` writes are pending or `interval` seconds
+    # passed. Repeated updates of a row become one, rows for the same table with
+    # no id needed are grouped into insert_many, a row deleted before it was ever
+    # written is dropped together with its insert. `flush` writes everything now.
+    # Writes that failed `retries` flushes in a row are tried one by one and the ones
+    # that still fail are set aside in `failed`, so they don't hold up everything else.
+
+    def __init__(self, database: Manager, size: int=200, interval: float=1.0, retries: int=RETRIES):
+        self.database = database
+        self.size = size
+        self.interval = interval
+        self.retries = retries
+        self.failures = 0
+        self.ops: List[list] = []
+        self.inserts: Dict[int, list] = {}
+        self.updates: Dict[int, list] = {}
+        self.waiting: Dict[int, List[asyncio.Future]] = {}
+        self.failed: List[list] = []
+        self.lock: asyncio.Lock = None
+        self.event: asyncio.Event = None
+        self.task: asyncio.Task = None
+
+    def __len__(self) -> int:
+        return len(self.ops)
+
+    def start(self):
+        if not self.task:
+            self.event = asyncio.Event()
+            self.task = asyncio.ensure_future(self.run())
+
+    def queue(self, op: list) -> list:
+        self.ops.append(op)
+        if self.event and len(self.ops) >= self.size:
+            self.event.set()
+        return op
+
+    def written(self) -> asyncio.Future:
+        # resolves to True once everything queued so far is written, False if any of it
+        # was set aside instead
+        future = asyncio.get_event_loop().create_future()
+        if self.ops:
+            self.waiting.setdefault(id(self.ops[-1]), []).append(future)
+        else:
+            future.set_result(True)
+        return future
+
+    def insert(self, instance):
+        self.inserts[id(instance)] = self.queue([INSERT, instance, None])
+
+    def insert_many(self, model, rows: List[dict]):
+        if self.ops and self.ops[-1][0] == INSERT_MANY and self.ops[-1][1] is model:
+            self.ops[-1][2].extend(rows)
+        else:
+            self.queue([INSERT_MANY, model, list(rows)])
+
+    def update(self, instance, *fields):
+        if id(instance) in self.inserts:
+            # the pending insert writes the current values anyway
+            return
+        op = self.updates.get(id(instance))
+        if op is None:
+            self.updates[id(instance)] = self.queue([UPDATE, instance, set(fields)])
+        elif op[2] and fields:
+            op[2].update(fields)
+        else:
+            op[2] = set()
+
+    def delete(self, instance):
+        insert = self.inserts.pop(id(instance), None)
+        update = self.updates.pop(id(instance), None)
+        if update:
+            update[0] = None
+        if insert:
+            insert[0] = None
+        else:
+            self.queue([DELETE, instance, None])
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.event.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.event.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("write behind flush failed")
+
+    async def flush(self):
+        self.lock = self.lock or asyncio.Lock()
+        async with self.lock:
+            ops, self.ops = self.ops, []
+            inserts, updates = self.inserts, self.updates
+            self.inserts, self.updates = {}, {}
+            if not any(op[0] for op in ops):
+                self.settle(ops, True)
+                return
+            try:
+                await self.write(ops)
+            except Exception:
+                self.failures += 1
+                if self.failures < self.retries:
+                    self.requeue(ops, inserts, updates)
+                    raise
+                log.exception("write behind flush failed %s times, writing one by one", self.failures)
+                self.failures = 0
+                await self.write_apart(ops, inserts, updates)
+                return
+            except BaseException:
+                self.requeue(ops, inserts, updates)
+                raise
+            self.failures = 0
+            self.settle(ops, True)
+
+    def requeue(self, ops: List[list], inserts: Dict[int, list], updates: Dict[int, list]):
+        # nothing of it was written, it goes first in the next flush ahead of the writes
+        # queued meanwhile, which may depend on it
+        self.ops = ops + self.ops
+        self.inserts, self.updates = {**inserts, **self.inserts}, {**updates, **self.updates}
+
+    def settle(self, ops: List[list], written: bool):
+        for op in ops:
+            for future in self.waiting.pop(id(op), []):
+                if not future.done():
+                    future.set_result(written)
+
+    async def write_apart(self, ops: List[list], inserts: Dict[int, list], updates: Dict[int, list]):
+        # a write that fails on its own is logged and set aside, later writes that depend
+        # on it fail and are set aside with it
+        written = True
+        for index, op in enumerate(ops):
+            try:
+                if op[0]:
+                    await self.write([op])
+            except Exception:
+                log.exception("write behind set aside %s of %s", op[0], op[1])
+                self.failed.append(op)
+                written = False
+            except BaseException:
+                left = ops[index:]
+                ids = {id(pending) for pending in left}
+                self.requeue(
+                    left, {key: pending for key, pending in inserts.items() if id(pending) in ids},
+                    {key: pending for key, pending in updates.items() if id(pending) in ids}
+                )
+                raise
+            self.settle([op], written)
+
+    async def write(self, ops: List[list]):
+        async with self.database.atomic():
+            for kind, target, payload in ops:
+                if kind == INSERT:
+                    await self.write_insert(target)
+                elif kind == INSERT_MANY:
+                    for start in range(0, len(payload), BATCH):
+                        await self.database.execute(target.insert_many(payload[start:start + BATCH]))
+                elif kind == UPDATE:
+                    only = [target._meta.fields[name] for name in payload] if payload else None
+                    await self.database.update(target, only=only)
+                elif kind == DELETE:
+                    await self.database.delete(target)
+
+    async def write_insert(self, instance):
+        # foreign keys may point at rows that were only written after the instance was built
+        for name, related in instance.__rel__.items():
+            instance.__data__[name] = related.get_id()
+        data = dict(instance.__data__)
+        data.pop(instance._meta.primary_key.name, None)
+        instance._pk = await self.database.execute(type(instance).insert(**data))